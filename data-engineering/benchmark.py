@@ -0,0 +1,316 @@
+import os
+import sys
+import json
+import time
+import shutil
+import zipfile
+import platform
+import threading
+import subprocess
+from datetime import datetime
+from functools import partial
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+
+import problem1
+import processor
+
+# resource is POSIX only: on Windows peak RSS is not measured (None)
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Benchmark of the download/process path with synthetic Divvy data.
+#
+#   python benchmark.py --rows 1000000,10000000,50000000 --zip --output bench.json
+#   python benchmark.py --rows 1000000 --compare bench.json
+#
+# For every layout and size it generates a trip file (once, it is reused),
+# serves it from a local HTTP server and measures each stage in a new process:
+# download, extract, parse and aggregate. For each stage it reports wall time,
+# rows/sec and peak RSS, and writes everything to a JSON file so two versions
+# can be compared with --compare (stages slower than REGRESSION_LIMIT and
+# NOISE_FLOOR are flagged).
+
+WORK_DIR = "bench_data"
+DEFAULT_ROWS = [1_000_000, 10_000_000, 50_000_000]
+LAYOUTS = ["tripduration", "rental_details", "started_ended"]
+# Rows generated and written at a time, so 50M rows do not need 50M rows in memory
+GENERATE_CHUNK = 1_000_000
+# A stage is a regression if it is this much slower than in the compared run
+# and at least NOISE_FLOOR seconds slower (short stages vary more than 10%
+# between two runs of the same code)
+REGRESSION_LIMIT = 0.10
+NOISE_FLOOR = 0.5
+
+# Quarter used in the file name of each layout (same names as the real files)
+LAYOUT_QUARTER = {
+    "tripduration": "2019_Q1",
+    "rental_details": "2019_Q2",
+    "started_ended": "2020_Q1",
+}
+
+
+# Read an option like "--rows 1000000,10000000" from the command line
+def get_arg(name: str, default: str = None) -> str:
+    if name in sys.argv:
+        i = sys.argv.index(name)
+        if i + 1 < len(sys.argv):
+            return sys.argv[i + 1]
+    return default
+
+
+# Peak memory of this process in MB (ru_maxrss is KB on Linux, bytes on macOS),
+# None without resource
+def peak_rss_mb():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+
+# One chunk of synthetic trips with the columns of the given layout.
+# Durations follow an exponential distribution with a long tail and some
+# values have thousands separators ("1,234.0"), like the real files.
+def generate_chunk(layout: str, first_id: int, n: int, rng) -> pd.DataFrame:
+    start = pd.Timestamp("2019-01-01") + pd.to_timedelta(rng.integers(0, 90 * 86400, n), unit="s")
+    duration = rng.exponential(900, n).round(1)
+    duration[rng.random(n) < 0.001] = rng.uniform(86400, 500000)
+    end = start + pd.to_timedelta(duration, unit="s")
+    start_text = start.strftime("%Y-%m-%d %H:%M:%S")
+    end_text = end.strftime("%Y-%m-%d %H:%M:%S")
+    duration_text = [f"{d:,.1f}" for d in duration]
+    stations = rng.integers(1, 600, (2, n))
+    ids = np.arange(first_id, first_id + n)
+
+    if layout == "tripduration":
+        return pd.DataFrame({
+            "trip_id": ids, "start_time": start_text, "end_time": end_text,
+            "bikeid": rng.integers(1, 6000, n), "tripduration": duration_text,
+            "from_station_id": stations[0], "from_station_name": "Station " + pd.Series(stations[0]).astype(str),
+            "to_station_id": stations[1], "to_station_name": "Station " + pd.Series(stations[1]).astype(str),
+            "usertype": "Subscriber", "gender": "Male", "birthyear": rng.integers(1940, 2005, n),
+        })
+    if layout == "rental_details":
+        return pd.DataFrame({
+            "01 - Rental Details Rental ID": ids,
+            "01 - Rental Details Local Start Time": start_text,
+            "01 - Rental Details Local End Time": end_text,
+            "01 - Rental Details Bike ID": rng.integers(1, 6000, n),
+            processor.DETAILS_DURATION_COL: duration_text,
+            "03 - Rental Start Station ID": stations[0],
+            "03 - Rental Start Station Name": "Station " + pd.Series(stations[0]).astype(str),
+            "02 - Rental End Station ID": stations[1],
+            "02 - Rental End Station Name": "Station " + pd.Series(stations[1]).astype(str),
+            "User Type": "Customer", "Member Gender": "Female",
+            "05 - Member Details Member Birthday Year": rng.integers(1940, 2005, n),
+        })
+    return pd.DataFrame({
+        "ride_id": ids, "rideable_type": "docked_bike",
+        "started_at": start_text, "ended_at": end_text,
+        "start_station_name": "Station " + pd.Series(stations[0]).astype(str), "start_station_id": stations[0],
+        "end_station_name": "Station " + pd.Series(stations[1]).astype(str), "end_station_id": stations[1],
+        "start_lat": 41.9, "start_lng": -87.6, "end_lat": 41.9, "end_lng": -87.6,
+        "member_casual": "member",
+    })
+
+
+# Write a synthetic trip file (and its zip if zipped) unless it already exists.
+# Returns the path of the file that the HTTP server will serve.
+def generate_file(layout: str, rows: int, out_dir: str, zipped: bool = True) -> str:
+    os.makedirs(out_dir, exist_ok=True)
+    name = f"Divvy_Trips_{LAYOUT_QUARTER[layout]}"
+    csv_path = os.path.join(out_dir, f"{name}.csv")
+    zip_path = os.path.join(out_dir, f"{name}.zip")
+    target = zip_path if zipped else csv_path
+    if os.path.exists(target):
+        return target
+
+    print(f"Generating {rows:,} rows ({layout})...")
+    rng = np.random.default_rng(rows)
+    tmp_path = csv_path + ".tmp"
+    for first in range(0, rows, GENERATE_CHUNK):
+        n = min(GENERATE_CHUNK, rows - first)
+        generate_chunk(layout, first, n, rng).to_csv(
+            tmp_path, mode="w" if first == 0 else "a", header=first == 0, index=False
+        )
+    os.replace(tmp_path, csv_path)
+
+    if zipped:
+        with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as z:
+            z.write(csv_path, os.path.basename(csv_path))
+        os.remove(csv_path)
+    return target
+
+
+# File server that does not print a line for every request
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+# Local stand-in for the Divvy S3 bucket: serves a folder over HTTP in a thread.
+# Returns the server (call shutdown() at the end) and its base URL.
+def start_server(directory: str):
+    handler = partial(QuietHandler, directory=directory)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+# --- Stages. Each one runs in a new process, so the peak RSS is its own. ---
+
+def stage_download(url: str, download_dir: str) -> dict:
+    problem1.DOWNLOAD_DIR = download_dir
+    problem1.MANIFEST_PATH = os.path.join(download_dir, "manifest.json")
+    os.makedirs(download_dir, exist_ok=True)
+    path = problem1.download_file(url, problem1.make_session(1))
+    if not path:
+        raise RuntimeError(f"download failed: {url}")
+    return {"bytes": os.path.getsize(path)}
+
+
+def stage_extract(zip_path: str, download_dir: str) -> dict:
+    problem1.DOWNLOAD_DIR = download_dir
+    names = problem1.unzip_and_delete(zip_path)
+    if names is None:
+        raise RuntimeError(f"extract failed: {zip_path}")
+    return {"bytes": sum(os.path.getsize(os.path.join(download_dir, n)) for n in names)}
+
+
+def stage_parse(csv_path: str, chunksize: int) -> dict:
+    schema = processor.detect_schema(processor.read_header(csv_path))
+    rows = 0
+    for df in processor.read_trip_chunks(csv_path, None, schema["usecols"], schema["dtype"], chunksize):
+        rows += len(df)
+    return {"rows": rows}
+
+
+def stage_aggregate(csv_path: str, chunksize: int) -> dict:
+    summary = processor.aggregate_file(csv_path, None, chunksize)
+    return {"rows": summary["count"], "mean_trip_time_minutes": summary["sum"] / summary["count"]}
+
+
+# Run a stage in a fresh process and add wall time and peak RSS to its result
+def run_stage(func, *args) -> dict:
+    with ProcessPoolExecutor(max_workers=1) as pool:
+        return pool.submit(measure, func, *args).result()
+
+
+# Runs inside the stage process
+def measure(func, *args) -> dict:
+    start = time.perf_counter()
+    result = func(*args)
+    result["seconds"] = time.perf_counter() - start
+    result["peak_rss_mb"] = peak_rss_mb()
+    return result
+
+
+# Download, extract, parse and aggregate one generated file
+def benchmark_file(layout: str, rows: int, zipped: bool, chunksize: int, base_url: str, serve_dir: str) -> list[dict]:
+    name = os.path.basename(generate_file(layout, rows, serve_dir, zipped))
+    download_dir = os.path.join(WORK_DIR, "downloads")
+    shutil.rmtree(download_dir, ignore_errors=True)
+
+    stages = []
+    download = run_stage(stage_download, f"{base_url}/{name}", download_dir)
+    stages.append({"stage": "download", **download})
+
+    local_path = os.path.join(download_dir, name)
+    if zipped:
+        extract = run_stage(stage_extract, local_path, download_dir)
+        stages.append({"stage": "extract", **extract})
+        local_path = os.path.splitext(local_path)[0] + ".csv"
+
+    stages.append({"stage": "parse", **run_stage(stage_parse, local_path, chunksize)})
+    stages.append({"stage": "aggregate", **run_stage(stage_aggregate, local_path, chunksize)})
+
+    for stage in stages:
+        stage.update({"layout": layout, "rows": rows, "zipped": zipped, "chunksize": chunksize})
+        stage["rows_per_sec"] = rows / stage["seconds"] if stage["seconds"] > 0 else None
+        rss = "-" if stage["peak_rss_mb"] is None else f"{stage['peak_rss_mb']:.1f}"
+        print(f"{layout:15s} {rows:>11,} {stage['stage']:10s} {stage['seconds']:8.2f}s "
+              f"{stage['rows_per_sec'] or 0:>14,.0f} rows/s {rss:>8} MB")
+    shutil.rmtree(download_dir, ignore_errors=True)
+    return stages
+
+
+# Version of the code that was measured (git commit if available)
+def code_version() -> str:
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__)))
+        return out.stdout.strip() or "unknown"
+    except OSError:
+        return "unknown"
+
+
+# Compare with a previous result file and print the stages that got slower
+def compare(results: dict, baseline_path: str) -> list[dict]:
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = json.load(f)
+
+    def key(s):
+        return (s["layout"], s["rows"], s["zipped"], s["chunksize"], s["stage"])
+
+    old = {key(s): s for s in baseline["stages"]}
+    regressions = []
+    for stage in results["stages"]:
+        before = old.get(key(stage))
+        if before is None or not before["seconds"]:
+            continue
+        change = stage["seconds"] / before["seconds"] - 1
+        if change > REGRESSION_LIMIT and stage["seconds"] - before["seconds"] > NOISE_FLOOR:
+            regressions.append({**stage, "baseline_seconds": before["seconds"], "change": change})
+            print(f"REGRESSION {stage['layout']} {stage['rows']:,} {stage['stage']}: "
+                  f"{before['seconds']:.2f}s -> {stage['seconds']:.2f}s ({change:+.0%})")
+    if not regressions:
+        print(f"No regressions against {baseline_path} ({baseline.get('version')})")
+    return regressions
+
+
+def main():
+    rows_list = [int(r) for r in get_arg("--rows", ",".join(map(str, DEFAULT_ROWS))).split(",")]
+    layouts = get_arg("--layouts", ",".join(LAYOUTS)).split(",")
+    zipped = "--zip" in sys.argv
+    chunksize = int(get_arg("--chunksize", "0"))
+    output = get_arg("--output", os.path.join(WORK_DIR, "benchmark.json"))
+    baseline = get_arg("--compare")
+
+    results = {
+        "version": code_version(),
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "csv_engine": processor.CSV_ENGINE,
+        "stages": [],
+    }
+
+    for rows in rows_list:
+        # One folder per size, the generated files are kept between runs
+        serve_dir = os.path.join(WORK_DIR, f"rows_{rows}")
+        for layout in layouts:
+            generate_file(layout, rows, serve_dir, zipped)
+
+        server, base_url = start_server(serve_dir)
+        try:
+            for layout in layouts:
+                results["stages"] += benchmark_file(layout, rows, zipped, chunksize, base_url, serve_dir)
+        finally:
+            server.shutdown()
+
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print("Saved:", output)
+
+    if baseline:
+        if compare(results, baseline):
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
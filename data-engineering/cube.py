@@ -0,0 +1,81 @@
+import os
+import json
+import sqlite3
+import pandas as pd
+
+import sketch
+
+# Pre-aggregated usage cube of the trips, built in the same pass as the mean
+# (processor.py --cube). One row per source file, date and hour of the day with
+# the number of trips, the sum of their durations and a duration sketch, so
+# questions like "trips per weekday and hour" or "p90 duration on weekends"
+# are answered from a few thousand rows instead of reading the CSVs again:
+#
+#   SELECT weekday, hour, SUM(trip_count), SUM(duration_sum_minutes) / SUM(trip_count)
+#   FROM trip_cube GROUP BY weekday, hour;
+#
+# Only valid durations (0-24h) with a start time are counted. weekday is 0 for
+# Monday to 6 for Sunday. Each run replaces the rows of the files it processed,
+# so the cube is updated one quarter at a time.
+
+CUBE_DB = os.path.join("processed", "divvy_cube.sqlite")
+
+
+# Connect to the cube database and create the table and indexes if needed
+def connect(db_path: str = CUBE_DB) -> sqlite3.Connection:
+    conn = sqlite3.connect(db_path)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS trip_cube (
+            source TEXT NOT NULL,
+            date TEXT NOT NULL,
+            hour INTEGER NOT NULL,
+            weekday INTEGER NOT NULL,
+            trip_count INTEGER NOT NULL,
+            duration_sum_minutes REAL NOT NULL,
+            duration_sketch TEXT NOT NULL,
+            PRIMARY KEY (source, date, hour)
+        );
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_trip_cube_date ON trip_cube (date, hour);")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_trip_cube_weekday ON trip_cube (weekday, hour);")
+    conn.commit()
+    return conn
+
+
+# Add one chunk of trips to the cells of a file. cells maps the start hour
+# (a Timestamp rounded down to the hour) to a duration summary (see sketch.py).
+def add_trips(cells: dict, start_time: pd.Series, duration_min: pd.Series) -> dict:
+    frame = pd.DataFrame({"hour": start_time.dt.floor("h"), "duration": duration_min}).dropna()
+    for hour, values in frame.groupby("hour")["duration"]:
+        cell = cells.setdefault(hour, sketch.new_sketch())
+        sketch.add_values(cell, values.to_numpy())
+    return cells
+
+
+# Replace the rows of one source file with its new cells
+def save_source(conn: sqlite3.Connection, source: str, cells: dict):
+    rows = [
+        (source, hour.strftime("%Y-%m-%d"), hour.hour, hour.dayofweek,
+         cell["count"], cell["sum"], json.dumps(cell))
+        for hour, cell in sorted(cells.items())
+    ]
+    with conn:
+        conn.execute("DELETE FROM trip_cube WHERE source = ?;", (source,))
+        conn.executemany("INSERT INTO trip_cube VALUES (?, ?, ?, ?, ?, ?, ?);", rows)
+
+
+# Delete the rows of files that are not in downloads anymore
+def drop_missing_sources(conn: sqlite3.Connection, sources: list[str]):
+    placeholders = ",".join("?" for _ in sources)
+    with conn:
+        conn.execute(f"DELETE FROM trip_cube WHERE source NOT IN ({placeholders});", sources)
+
+
+# Merge the sketches of the rows that match a WHERE clause, for example
+# duration_summary(conn, "weekday >= 5") -> summary of weekend trips,
+# then sketch.quantile(summary, 0.9) gives the p90 duration
+def duration_summary(conn: sqlite3.Connection, where: str = "1 = 1", params: tuple = ()) -> dict:
+    summary = sketch.new_sketch()
+    for (data,) in conn.execute(f"SELECT duration_sketch FROM trip_cube WHERE {where};", params):
+        summary = sketch.merge(summary, sketch.from_json(json.loads(data)))
+    return summary
@@ -1,7 +1,13 @@
 import os
+import sys
+import json
+import time
+import hashlib
 import logging
 import requests
 import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
 
 download_uris = [
     "https://divvy-tripdata.s3.amazonaws.com/Divvy_Trips_2018_Q4.zip",
@@ -15,6 +21,20 @@ download_uris = [
 
 DOWNLOAD_DIR = "downloads"
 
+# Max number of files downloaded at the same time (--workers N)
+MAX_WORKERS = 4
+
+# Bytes read from the network per write (--chunk-size N)
+CHUNK_SIZE = 1024 * 1024
+# Print the progress of a download every 50 MB
+PROGRESS_EVERY = 50 * 1024 * 1024
+
+# Remembers what was downloaded (ETag, Last-Modified, size, hash, local files)
+# so the next run only downloads the quarters that changed on the server
+MANIFEST_PATH = os.path.join(DOWNLOAD_DIR, "manifest.json")
+# Returned by download_file when the server copy is the same as ours
+NOT_MODIFIED = "not-modified"
+
 # If the folder does not exist, create it
 def ensure_download_dir():
     if not os.path.exists(DOWNLOAD_DIR):
@@ -24,21 +44,151 @@ def ensure_download_dir():
         print("Folder already exists:", DOWNLOAD_DIR)
 
 
+# Read an integer option like "--workers 4" from the command line
+def get_int_arg(name: str, default: int) -> int:
+    if name in sys.argv:
+        i = sys.argv.index(name)
+        if i + 1 < len(sys.argv):
+            return int(sys.argv[i + 1])
+    return default
+
+
+# Creates a Session that reuses connections (keep-alive) between downloads.
+# The pool is as big as the number of workers so no thread waits for a connection.
+def make_session(pool_size: int = MAX_WORKERS) -> requests.Session:
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
 # Downloads a zip file and saves it in DOWNLOAD_DIR.
-def download_file(url: str):
+# The body is streamed in chunks to "<name>.part" and renamed at the end, so a
+# big zip is never held in memory and a half-written file never looks finished.
+# If a ".part" file is left from a previous run, the download resumes from there
+# with an HTTP Range request. If-Range makes the server send the whole file
+# instead (200) if it changed since the ".part" was started, so bytes of two
+# versions are never joined.
+#
+# With a manifest, the request is conditional (If-None-Match / If-Modified-Since)
+# and NOT_MODIFIED is returned when the server answers 304 or sends the same
+# bytes again (same sha256). force=True ignores the manifest and downloads again.
+# keep_zip is the mode of this run: if the cached files are the extracted CSVs
+# the zip is downloaded again, and if they are a zip kept by a --keep-zip run
+# its path is returned (when it did not change) so it gets extracted.
+def download_file(url: str, session: requests.Session = None, chunk_size: int = CHUNK_SIZE,
+                  manifest: dict = None, force: bool = False, keep_zip: bool = False):
     # Extract the file name from the URL (everything after the last "/")
     filename = url.rsplit("/", 1)[-1]
     # Build the full path where the file will be saved
     path = os.path.join(DOWNLOAD_DIR, filename)
+    part_path = path + ".part"
+    # Use the shared session if we have one, if not a plain request
+    http = session if session is not None else requests
     try:
+        start = time.perf_counter()
+
+        # Ask only for the missing bytes if there is a partial download of a
+        # known version of the file, if not start again
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        validator = partial_validator(part_path) if offset else None
+        if offset and not validator:
+            remove_partial(part_path)
+            offset = 0
+        headers = {"Range": f"bytes={offset}-", "If-Range": validator} if offset else {}
+
+        # Only ask "has it changed?" if the files of the last download are still here
+        # and can be used in this mode (extracted CSVs can not give back the zip)
+        entry = manifest.get(url) if manifest is not None else None
+        cached = bool(entry) and not force and not offset and cached_files_exist(entry)
+        if cached and not (keep_zip and not cached_as_zip(entry)):
+            headers.update(conditional_headers(entry))
+
         # Send HTTP request to download the file
-        r = requests.get(url, timeout=20)
-        # Raise an exception if status code is not 200 (e.g. 404 not found)
-        r.raise_for_status()
-        # Save the file content in binary mode
-        with open(path, "wb") as f:
-            f.write(r.content)
-        print("Downloaded:", filename)
+        with http.get(url, timeout=20, stream=True, headers=headers) as r:
+            # The partial file does not fit the file on the server, start again
+            if r.status_code == 416:
+                remove_partial(part_path)
+                return download_file(url, session, chunk_size, manifest, force, keep_zip)
+            # 304 = our copy is still the latest one
+            if r.status_code == 304:
+                print("Not modified:", filename)
+                if not keep_zip and cached_as_zip(entry):
+                    # zip left by a --keep-zip run, extract it now
+                    return path
+                return NOT_MODIFIED
+            # Raise an exception if status code is not 200/206 (e.g. 404 not found)
+            r.raise_for_status()
+
+            # 206 = the server accepted the Range, anything else sends the whole file
+            if r.status_code != 206:
+                offset = 0
+            if offset:
+                print(f"Resuming: {filename} from {offset / (1024 * 1024):.1f} MB")
+
+            etag = r.headers.get("ETag")
+            last_modified = r.headers.get("Last-Modified")
+            # version of the file the new ".part" belongs to, for a later resume
+            if not offset:
+                save_partial_validator(part_path, etag, last_modified)
+            length = r.headers.get("Content-Length")
+            total = offset + int(length) if length else None
+
+            # Hash the content while it is written (including the resumed part)
+            sha256 = hashlib.sha256()
+            if offset:
+                hash_file(part_path, sha256, chunk_size)
+
+            # Save the file content in binary mode, chunk by chunk
+            received = 0
+            next_report = PROGRESS_EVERY
+            with open(part_path, "ab" if offset else "wb") as f:
+                for chunk in r.iter_content(chunk_size=chunk_size):
+                    f.write(chunk)
+                    sha256.update(chunk)
+                    received += len(chunk)
+                    if received >= next_report:
+                        print_progress(filename, offset + received, total, received, start)
+                        next_report += PROGRESS_EVERY
+
+        # Keep the .part file (to resume later) if the connection was cut
+        if total is not None and offset + received < total:
+            raise IOError(f"incomplete download ({offset + received} of {total} bytes)")
+
+        # Atomic rename: the zip only appears when it is complete
+        os.replace(part_path, path)
+        remove_partial(part_path)
+        elapsed = time.perf_counter() - start
+        print("Downloaded:", filename, "-", format_throughput(received, elapsed))
+
+        if manifest is None:
+            return path
+
+        digest = sha256.hexdigest()
+        unchanged = (not force and entry is not None and entry.get("sha256") == digest
+                     and cached_files_exist(entry) and cached_as_zip(entry) == keep_zip)
+        manifest[url] = {
+            "file": filename,
+            "etag": etag,
+            "last_modified": last_modified,
+            "size": os.path.getsize(path),
+            "sha256": digest,
+            "files": entry["files"] if unchanged else [filename],
+            "zipped": cached_as_zip(entry) if unchanged else True,
+        }
+
+        # New version (or extracted CSVs replaced by the zip): the files of the old
+        # one are not tracked any more, so eviction would leave them behind
+        if entry is not None and not unchanged:
+            remove_untracked(entry, manifest[url]["files"])
+
+        # Server without ETag/Last-Modified: same bytes, no need to extract again
+        if unchanged:
+            if filename not in entry["files"]:
+                os.remove(path)
+            print("Same content as before:", filename)
+            return NOT_MODIFIED
         return path
     except Exception as e:
         # If something goes wrong (bad URL, timeout, etc.)
@@ -46,34 +196,219 @@ def download_file(url: str):
         return None
 
 
+# The ETag (or Last-Modified) of the file a ".part" download belongs to, saved
+# next to it in "<name>.part.json". None if it is unknown. Weak ETags (W/...)
+# can not be used in If-Range.
+def partial_validator(part_path: str):
+    try:
+        with open(part_path + ".json", "r", encoding="utf-8") as f:
+            info = json.load(f)
+    except (OSError, ValueError):
+        return None
+    etag = info.get("etag")
+    if etag and not etag.startswith("W/"):
+        return etag
+    return info.get("last_modified")
+
+
+def save_partial_validator(part_path: str, etag, last_modified):
+    with open(part_path + ".json", "w", encoding="utf-8") as f:
+        json.dump({"etag": etag, "last_modified": last_modified}, f)
+
+
+# Deletes a ".part" download and its validator file
+def remove_partial(part_path: str):
+    for path in (part_path, part_path + ".json"):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+# Prints how much of a file has been downloaded and the speed so far
+def print_progress(filename: str, done: int, total, received: int, start: float):
+    mb = 1024 * 1024
+    elapsed = time.perf_counter() - start
+    rate = received / mb / elapsed if elapsed > 0 else 0.0
+    if total:
+        print(f"  {filename}: {done / mb:.0f}/{total / mb:.0f} MB ({100 * done / total:.0f}%) {rate:.1f} MB/s")
+    else:
+        print(f"  {filename}: {done / mb:.0f} MB {rate:.1f} MB/s")
+
+
+# Adds the bytes of a file to a hashlib object
+def hash_file(path: str, digest, chunk_size: int = CHUNK_SIZE):
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+
+
+# Reads the download manifest (empty if this is the first run)
+def load_manifest() -> dict:
+    if not os.path.exists(MANIFEST_PATH):
+        return {}
+    try:
+        with open(MANIFEST_PATH, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print("Could not read manifest, starting a new one -", e)
+        return {}
+
+
+# Writes the manifest to a temporary file first so it is never half written
+def save_manifest(manifest: dict):
+    tmp_path = MANIFEST_PATH + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, MANIFEST_PATH)
+
+
+# True if every local file written for this URL (zip or extracted CSVs) is still there
+def cached_files_exist(entry: dict) -> bool:
+    files = entry.get("files") or []
+    return bool(files) and all(os.path.exists(os.path.join(DOWNLOAD_DIR, f)) for f in files)
+
+
+# True if the local files of this URL are the zip itself (--keep-zip), False if
+# they are the extracted CSVs. Manifests written before "zipped" have only the
+# zip name in "files" in that case.
+def cached_as_zip(entry: dict) -> bool:
+    return entry.get("zipped", entry.get("files") == [entry.get("file")])
+
+
+# Headers that make the server answer 304 if the file has not changed
+def conditional_headers(entry: dict) -> dict:
+    headers = {}
+    if entry.get("etag"):
+        headers["If-None-Match"] = entry["etag"]
+    if entry.get("last_modified"):
+        headers["If-Modified-Since"] = entry["last_modified"]
+    return headers
+
+
+# Delete the local files of an old manifest entry that are not in "keep"
+def remove_untracked(entry: dict, keep: list[str]):
+    for f in entry.get("files") or []:
+        path = os.path.join(DOWNLOAD_DIR, f)
+        if f not in keep and os.path.exists(path):
+            os.remove(path)
+
+
+# Quarters that are no longer in download_uris: delete their files and forget them
+def evict_stale(manifest: dict, uris: list[str]):
+    for url in [u for u in manifest if u not in uris]:
+        for f in manifest[url].get("files") or []:
+            path = os.path.join(DOWNLOAD_DIR, f)
+            if os.path.exists(path):
+                os.remove(path)
+        del manifest[url]
+        print("Evicted from cache:", url)
+
+
 # Extracts the zip file into DOWNLOAD_DIR and deletes the zip file.
+# Returns the names of the extracted files (None if the zip could not be opened).
 def unzip_and_delete(zip_path: str):
     try:
         # Open the .zip file safely
         with zipfile.ZipFile(zip_path, "r") as z:
             # Extract all contents into the download folder
             z.extractall(DOWNLOAD_DIR)
+            names = [n for n in z.namelist() if not n.endswith("/")]
         # Remove the .zip file after extraction to save space
         os.remove(zip_path)
         print("Extracted and deleted:", os.path.basename(zip_path))
+        return names
     except Exception as e:
         # If the file is not a valid zip or cannot be opened
         print("Could not open ZIP:", zip_path, "-", e)
+        return None
+
+
+# Text like "12.3 MB in 2.1s (5.9 MB/s)" for the logs
+def format_throughput(n_bytes: int, seconds: float) -> str:
+    mb = n_bytes / (1024 * 1024)
+    rate = mb / seconds if seconds > 0 else 0.0
+    return f"{mb:.1f} MB in {seconds:.1f}s ({rate:.1f} MB/s)"
 
 
 # Downloads each URI and processes it (unzip + delete)
-def process_all():
-    for url in download_uris:
-        path = download_file(url)
-        if path:  # only if it was downloaded successfully
-            unzip_and_delete(path)
+# With keep_zip the zips are left as they are, so processor.py --from-zip
+# can read the CSVs from inside them without writing them to disk again.
+# Files that did not change since the last run (see MANIFEST_PATH) are skipped.
+def process_all(uris: list[str] = download_uris, chunk_size: int = CHUNK_SIZE,
+                keep_zip: bool = False, force: bool = False):
+    manifest = load_manifest()
+    evict_stale(manifest, uris)
+
+    for url in uris:
+        path = download_file(url, chunk_size=chunk_size, manifest=manifest, force=force, keep_zip=keep_zip)
+        if path and path != NOT_MODIFIED and not keep_zip:  # only if it is a new file
+            record_extracted(manifest, url, unzip_and_delete(path))
+
+    save_manifest(manifest)
+
+
+# Remember which files came out of the zip of this URL
+def record_extracted(manifest: dict, url: str, names):
+    if names is None:
+        # The zip was not valid: forget it so it is downloaded again next time
+        manifest.pop(url, None)
+    else:
+        manifest[url]["files"] = names
+        manifest[url]["zipped"] = False
+
+
+# Same as process_all but downloads several files at the same time.
+# Downloads share one Session (connection pool) and each zip is extracted
+# as soon as it arrives, while the other downloads are still running.
+def process_all_concurrent(uris: list[str] = download_uris, workers: int = MAX_WORKERS,
+                           chunk_size: int = CHUNK_SIZE, keep_zip: bool = False,
+                           force: bool = False):
+    start = time.perf_counter()
+    total_bytes = 0
+    session = make_session(workers)
+    manifest = load_manifest()
+    evict_stale(manifest, uris)
+
+    # One thread for extraction is enough, unzipping is limited by the disk
+    with ThreadPoolExecutor(max_workers=workers) as download_pool, \
+            ThreadPoolExecutor(max_workers=1) as extract_pool:
+        futures = {
+            download_pool.submit(download_file, url, session, chunk_size, manifest, force, keep_zip): url
+            for url in uris
+        }
+        extractions = {}
+
+        for future in as_completed(futures):
+            path = future.result()
+            if path and path != NOT_MODIFIED:  # only if it is a new file
+                total_bytes += os.path.getsize(path)
+                if not keep_zip:
+                    extractions[extract_pool.submit(unzip_and_delete, path)] = futures[future]
+
+        # Wait until every zip has been extracted
+        for extraction, url in extractions.items():
+            record_extracted(manifest, url, extraction.result())
+
+    session.close()
+    save_manifest(manifest)
+    elapsed = time.perf_counter() - start
+    print(f"Total ({len(uris)} files, {workers} workers):", format_throughput(total_bytes, elapsed))
 
 
 def main() -> None:
     # Ensure the target folder exists before downloading
     ensure_download_dir()
     # Loop through all URIs and process them
-    process_all()
+    workers = get_int_arg("--workers", 1)
+    chunk_size = get_int_arg("--chunk-size", CHUNK_SIZE)
+    # --keep-zip: do not extract, processor.py --from-zip reads the zips directly
+    keep_zip = "--keep-zip" in sys.argv
+    # --force: download everything again even if the manifest says it did not change
+    force = "--force" in sys.argv
+    if workers > 1:
+        process_all_concurrent(workers=workers, chunk_size=chunk_size, keep_zip=keep_zip,
+                               force=force)
+    else:
+        process_all(chunk_size=chunk_size, keep_zip=keep_zip, force=force)
 
 
 if __name__ == "__main__":
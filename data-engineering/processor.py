@@ -91,12 +91,81 @@
 
 import os
 import re
+import sys
+import glob
+import json
+import hashlib
+import zipfile
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 
+import cube
+import sketch
+
+# pyarrow parses CSV much faster than the default engine and is needed for
+# the Parquet cache, but it is optional
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    CSV_ENGINE = "pyarrow"
+except ImportError:
+    pa = None
+    CSV_ENGINE = "c"
+
 DOWNLOAD_DIR = "downloads"
 PROCESSED_DIR = "processed"
 OUTPUT_PATH = os.path.join(PROCESSED_DIR, "mean_trip_time_by_quarter.csv")
 
+# Parquet copy of every trip file with only duration_sec and start_time (--cache).
+# Ad-hoc analyses can read it directly: pd.read_parquet(CACHE_DIR, columns=[...])
+CACHE_DIR = "cache"
+
+# Partial results of every file with the fingerprint of its source (--incremental),
+# so files that did not change are not read again
+PARTIALS_PATH = os.path.join(PROCESSED_DIR, "partials.json")
+
+# Rows per chunk in streaming mode (--stream, or --chunksize N)
+CHUNK_ROWS = 500_000
+
+DETAILS_DURATION_COL = "01 - Rental Details Duration In Seconds Uncapped"
+
+# Timestamp formats seen in the Divvy files. The format of a column is detected
+# once from the first TIMESTAMP_SAMPLE values and then used for the whole file.
+TIMESTAMP_FORMATS = [
+    "%Y-%m-%d %H:%M:%S",
+    "%Y-%m-%d %H:%M",
+    "%m/%d/%Y %H:%M:%S",
+    "%m/%d/%Y %H:%M",
+]
+TIMESTAMP_SAMPLE = 1000
+
+# Known layouts of the Divvy trip files, in the same order as the checks in
+# duration_minutes(). Only "usecols" are parsed, the rest of the columns
+# (stations, users, ids...) are skipped. Durations are read as text (str) and
+# converted later with pd.to_numeric, like before, so bad values become NaN.
+# "start" is the column with the start time of the trip (used by the cache).
+SCHEMAS = [
+    {
+        "name": "tripduration",  # 2018-2019 quarters
+        "usecols": ["tripduration"],
+        "dtype": {"tripduration": str},
+        "start": "start_time",
+    },
+    {
+        "name": "rental_details",  # 2019 Q2
+        "usecols": [DETAILS_DURATION_COL],
+        "dtype": {DETAILS_DURATION_COL: str},
+        "start": "01 - Rental Details Local Start Time",
+    },
+    {
+        "name": "started_ended",  # 2020 onwards
+        "usecols": ["started_at", "ended_at"],
+        "dtype": {"started_at": str, "ended_at": str},
+        "start": "started_at",
+    },
+]
+
 # Extract year and quarter from filename
 def get_year_quarter(filename: str):
     m = re.search(r"Divvy_Trips_(\d{4})_(Q[1-4])", filename)
@@ -105,6 +174,446 @@ def get_year_quarter(filename: str):
     return None, None
 
 
+# Read an integer option like "--chunksize 100000" from the command line
+def get_int_arg(name: str, default: int) -> int:
+    if name in sys.argv:
+        i = sys.argv.index(name)
+        if i + 1 < len(sys.argv):
+            return int(sys.argv[i + 1])
+    return default
+
+
+# List the trip files to process as (file, path, member).
+# With from_zip the CSVs are read from inside the zips kept by
+# "python problem1.py --keep-zip" and member is the name inside the zip,
+# otherwise member is None and path is an extracted CSV.
+def list_sources(from_zip: bool = False) -> list[tuple]:
+    sources = []
+    for file in sorted(os.listdir(DOWNLOAD_DIR)):
+        path = os.path.join(DOWNLOAD_DIR, file)
+
+        if not from_zip:
+            if file.lower().endswith(".csv"):
+                sources.append((file, path, None))
+            continue
+
+        if not file.lower().endswith(".zip"):
+            continue
+        try:
+            with zipfile.ZipFile(path, "r") as z:
+                for member in z.namelist():
+                    name = os.path.basename(member)
+                    # Skip folders and macOS metadata, keep the Divvy_Trips_YYYY_QN files
+                    if not name or member.startswith("__MACOSX"):
+                        continue
+                    if get_year_quarter(name) == (None, None):
+                        continue
+                    sources.append((name, path, member))
+        except zipfile.BadZipFile as e:
+            print(f"Saltando {file}: ZIP no válido - {e}")
+    return sources
+
+
+# Give pd.read_csv something to read: the CSV path or the open zip member
+@contextmanager
+def open_source(path: str, member: str = None):
+    if member is None:
+        yield path
+        return
+    with zipfile.ZipFile(path, "r") as z, z.open(member) as f:
+        yield f
+
+
+# Read only the header of a trip file
+def read_header(path: str, member: str = None) -> list[str]:
+    with open_source(path, member) as src:
+        return list(pd.read_csv(src, nrows=0).columns)
+
+
+# Find the layout of a file from its header (None if it is not a known one)
+def detect_schema(columns: list[str]):
+    for schema in SCHEMAS:
+        if all(c in columns for c in schema["usecols"]):
+            return schema
+    return None
+
+
+# Format of TIMESTAMP_FORMATS that parses most values of the sample, so one bad
+# value does not disable the fast path (None if no format parses at least half
+# of the sample, then the slow pandas inference is used)
+def detect_timestamp_format(sample: pd.Series):
+    best, best_ok = None, 0
+    for fmt in TIMESTAMP_FORMATS:
+        ok = int(pd.to_datetime(sample, format=fmt, errors="coerce").notna().sum())
+        if ok > best_ok:
+            best, best_ok = fmt, ok
+    return best if best_ok * 2 >= len(sample) else None
+
+
+# Same result as pd.to_datetime(values, errors="coerce"), but faster:
+# - the format is detected once per column and kept in parsers between chunks,
+#   so pandas does not have to infer it (slow, element by element on old pandas)
+# - cache=True parses each repeated value only once (trips start and end at
+#   second granularity, so many values repeat)
+# - values that do not fit the format go through pd.to_datetime without
+#   format (the old slow path) and are counted in parsers[column]["slow_rows"]
+def parse_timestamps(df: pd.DataFrame, column: str, parsers: dict = None) -> pd.Series:
+    parsers = {} if parsers is None else parsers
+    parser = parsers.setdefault(column, {"format": None, "detected": False, "slow_rows": 0})
+    values = df[column]
+
+    if not parser["detected"]:
+        sample = values.dropna().head(TIMESTAMP_SAMPLE)
+        if not sample.empty:
+            parser["format"] = detect_timestamp_format(sample)
+            parser["detected"] = True
+
+    if parser["format"] is None:
+        return pd.to_datetime(values, errors="coerce", cache=True)
+
+    parsed = pd.to_datetime(values, format=parser["format"], errors="coerce", cache=True)
+    failed = parsed.isna() & values.notna()
+    if failed.any():
+        parsed[failed] = pd.to_datetime(values[failed], errors="coerce")
+        parser["slow_rows"] += int(failed.sum())
+    return parsed
+
+
+# Print how many timestamps of a file did not fit the detected format
+def report_slow_timestamps(name: str, parsers: dict):
+    for column, parser in parsers.items():
+        if parser["slow_rows"]:
+            print(f"AVISO: {name}: {parser['slow_rows']} valores de {column} no siguen el formato "
+                  f"{parser['format']}, se han leído sin formato (más lento)")
+
+
+# Trip duration in seconds, using the columns this quarter has.
+# Returns None if the file has none of the known duration columns.
+# parsers keeps the detected timestamp formats between chunks of a file.
+def duration_seconds(df: pd.DataFrame, parsers: dict = None):
+    if "tripduration" in df.columns:
+        return pd.to_numeric(df["tripduration"], errors="coerce")
+
+    elif DETAILS_DURATION_COL in df.columns:
+        # Q2 doen't have tripduration, but has this other column in seconds
+        duration_sec = (
+            df[DETAILS_DURATION_COL]
+            .astype(str)
+            .str.replace(",", "", regex=False)
+        )
+        return pd.to_numeric(duration_sec, errors="coerce")
+
+    #some Q files dont have tripduration, have started_at and ended_at columns
+    elif "started_at" in df.columns and "ended_at" in df.columns:
+        start = parse_timestamps(df, "started_at", parsers)
+        end = parse_timestamps(df, "ended_at", parsers)
+        return (end - start).dt.total_seconds()
+
+    return None
+
+
+# Trip duration in minutes (None if the file has no duration columns)
+def duration_minutes(df: pd.DataFrame, parsers: dict = None):
+    duration_sec = duration_seconds(df, parsers)
+    if duration_sec is None:
+        return None
+    return duration_sec / 60
+
+
+# Same table for every layout: duration_sec and start_time.
+# This is what is stored in the Parquet cache.
+def normalize_trips(df: pd.DataFrame, schema: dict, parsers: dict = None) -> pd.DataFrame:
+    return pd.DataFrame({
+        "duration_sec": duration_seconds(df, parsers).astype("float64"),
+        "start_time": parse_timestamps(df, schema["start"], parsers),
+    })
+
+
+# Keep only valid durations: no nulls and between 0 and 24 hours
+def valid_durations(duration_min: pd.Series) -> pd.Series:
+    # Clean nulls
+    duration_min = duration_min.dropna()
+    # Remove invalid values
+    return duration_min[(duration_min >= 0) & (duration_min <= 24 * 60)]
+
+
+# Read the columns of a trip file, all at once or in chunks of chunksize rows
+# (pyarrow cannot read in chunks, so it is used only without chunksize)
+def read_trip_chunks(path: str, member: str, usecols: list[str], dtype: dict, chunksize: int = 0):
+    with open_source(path, member) as src:
+        if chunksize:
+            yield from pd.read_csv(src, chunksize=chunksize, usecols=usecols, dtype=dtype)
+        else:
+            yield pd.read_csv(src, engine=CSV_ENGINE, usecols=usecols, dtype=dtype)
+
+
+# Where a source is: file path plus the member name for CSVs inside zips
+def source_key(path: str, member: str = None) -> str:
+    return f"{os.path.abspath(path)}|{member}"
+
+
+# Size and modification time of a source file, it changes when the file changes
+def source_fingerprint(path: str) -> str:
+    st = os.stat(path)
+    return f"{st.st_size}|{st.st_mtime_ns}"
+
+
+# Cache file of a source. The name has a hash of where the source is (path and
+# zip member) and another of its size and modification time, so when the source
+# changes the old cache file is not found anymore and a new one is made.
+def cache_path_for(path: str, member: str = None) -> str:
+    source_id = hashlib.sha1(source_key(path, member).encode()).hexdigest()[:10]
+    fingerprint = hashlib.sha1(source_fingerprint(path).encode()).hexdigest()[:10]
+    name = os.path.splitext(os.path.basename(member or path))[0]
+    return os.path.join(CACHE_DIR, f"{name}-{source_id}-{fingerprint}.parquet")
+
+
+# Read columns of a cache file, in batches of chunksize rows if chunksize is set
+def read_cache(cache_path: str, columns: list[str], chunksize: int = 0):
+    if not chunksize:
+        yield pd.read_parquet(cache_path, columns=columns)
+        return
+    for batch in pq.ParquetFile(cache_path).iter_batches(batch_size=chunksize, columns=columns):
+        yield batch.to_pandas()
+
+
+# Columns and dtypes to read for the normalized table: the duration columns
+# of the layout plus its start time
+def trip_columns(schema: dict) -> tuple[list[str], dict]:
+    usecols = list(dict.fromkeys(schema["usecols"] + [schema["start"]]))
+    dtype = {**schema["dtype"], schema["start"]: str}
+    return usecols, dtype
+
+
+# Convert a trip file to the normalized table and write it to the cache while
+# the chunks are given back to the caller. The file is written as ".tmp" and
+# renamed at the end, and older cache files of the same source are deleted.
+def write_cache(path: str, member: str, schema: dict, cache_path: str, chunksize: int = 0,
+                parsers: dict = None):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tmp_path = cache_path + ".tmp"
+    writer = None
+    try:
+        for df in read_trip_chunks(path, member, *trip_columns(schema), chunksize):
+            trips = normalize_trips(df, schema, parsers)
+            table = pa.Table.from_pandas(trips, preserve_index=False)
+            if writer is None:
+                writer = pq.ParquetWriter(tmp_path, table.schema)
+            writer.write_table(table)
+            yield trips
+    finally:
+        if writer is not None:
+            writer.close()
+
+    prefix = cache_path.rsplit("-", 1)[0]
+    for old in glob.glob(glob.escape(prefix) + "-*.parquet"):
+        os.remove(old)
+    os.replace(tmp_path, cache_path)
+
+
+# Delete cache files of sources that are not in downloads anymore
+def clean_cache(sources: list[tuple]):
+    if not os.path.isdir(CACHE_DIR):
+        return
+    keep = {os.path.basename(cache_path_for(path, member)) for _, path, member in sources}
+    for file in os.listdir(CACHE_DIR):
+        if file not in keep:
+            os.remove(os.path.join(CACHE_DIR, file))
+            print("Cache eliminada:", file)
+
+
+# Summary of the valid trip durations (minutes) of one file: count, sum, std,
+# min, max and the quantile sketch (see sketch.py), all in the same pass.
+# The header is read first to know the layout, then only the columns of that
+# layout are parsed. With chunksize the file is read in pieces of that many
+# rows and only the running summary is kept, so memory does not grow with
+# the file size. With use_cache the durations come from the Parquet cache if
+# the source did not change, if not the cache is written in the same pass.
+# With cube_cells the start time is read too and the trips are also added to
+# the usage cube cells of the file (see cube.py).
+# Returns None if the file has no columns to calculate the duration.
+def aggregate_file(path: str, member: str = None, chunksize: int = 0, use_cache: bool = False,
+                   cube_cells: dict = None):
+    parsers = {}
+    name = os.path.basename(member or path)
+    with_start = cube_cells is not None
+    cache_path = cache_path_for(path, member) if use_cache else None
+    if cache_path and os.path.exists(cache_path):
+        columns = ["duration_sec", "start_time"] if with_start else ["duration_sec"]
+        trips = ((df["duration_sec"] / 60, df.get("start_time"))
+                 for df in read_cache(cache_path, columns, chunksize))
+    else:
+        header = read_header(path, member)
+        schema = detect_schema(header)
+        if schema is None:
+            print(f"AVISO: {name} tiene un formato desconocido. Columnas: {header}")
+            print(f"       Formatos conocidos: {[s['usecols'] for s in SCHEMAS]}")
+            return None
+
+        if schema["start"] not in header:
+            if cache_path:
+                print(f"AVISO: {schema['start']} no está en {name}, no se guarda en cache")
+                cache_path = None
+            if with_start:
+                print(f"AVISO: {schema['start']} no está en {name}, no se añade al cubo")
+                with_start = False
+
+        if cache_path:
+            trips = ((df["duration_sec"] / 60, df["start_time"])
+                     for df in write_cache(path, member, schema, cache_path, chunksize, parsers))
+        elif with_start:
+            chunks = read_trip_chunks(path, member, *trip_columns(schema), chunksize)
+            trips = ((df["duration_sec"] / 60, df["start_time"])
+                     for df in (normalize_trips(df, schema, parsers) for df in chunks))
+        else:
+            chunks = read_trip_chunks(path, member, schema["usecols"], schema["dtype"], chunksize)
+            trips = ((duration_minutes(df, parsers), None) for df in chunks)
+
+    summary = sketch.new_sketch()
+    for duration_min, start_time in trips:
+        duration_min = valid_durations(duration_min)
+        sketch.add_values(summary, duration_min.to_numpy())
+        if with_start:
+            cube.add_trips(cube_cells, start_time[duration_min.index], duration_min)
+
+    report_slow_timestamps(name, parsers)
+    return summary
+
+
+# Small result of one file: year, quarter and the summary partial (and the
+# usage cube cells with use_cube, saved by the main process).
+# It runs inside the worker processes with --workers, so errors are caught
+# here and returned as "error" instead of stopping the other files.
+def process_source(source: tuple, chunksize: int = 0, use_cache: bool = False,
+                   use_cube: bool = False) -> dict:
+    file, path, member = source
+    year, quarter = get_year_quarter(file)
+    result = {"file": file, "year": year, "quarter": quarter}
+    try:
+        cube_cells = {} if use_cube else None
+        result["partial"] = aggregate_file(path, member, chunksize, use_cache, cube_cells)
+        if use_cube:
+            result["cube"] = cube_cells
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+    return result
+
+
+# Process every file, in parallel when workers > 1.
+# Results are returned in the same order as sources, whatever finishes first.
+def process_sources(sources: list[tuple], chunksize: int = 0, workers: int = 1,
+                    use_cache: bool = False, use_cube: bool = False) -> list[dict]:
+    if workers <= 1:
+        return [process_source(source, chunksize, use_cache, use_cube) for source in sources]
+
+    results = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(process_source, source, chunksize, use_cache, use_cube)
+                   for source in sources]
+        for source, future in zip(sources, futures):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                # e.g. the worker process died
+                results.append({"file": source[0], "error": f"{type(e).__name__}: {e}"})
+    return results
+
+
+# Extra columns of the output: count, std, min, max and p50/p90/p99.
+# The percentiles come from the sketch and have up to 1% relative error.
+def duration_stats(summary: dict) -> dict:
+    return {
+        "trip_count": summary["count"],
+        "std_trip_time_minutes": sketch.std(summary),
+        "min_trip_time_minutes": summary["min"],
+        "p50_trip_time_minutes": sketch.quantile(summary, 0.50),
+        "p90_trip_time_minutes": sketch.quantile(summary, 0.90),
+        "p99_trip_time_minutes": sketch.quantile(summary, 0.99),
+        "max_trip_time_minutes": summary["max"],
+    }
+
+
+# Reads the stored partial results (empty if there are none yet)
+def load_partials() -> dict:
+    if not os.path.exists(PARTIALS_PATH):
+        return {}
+    try:
+        with open(PARTIALS_PATH, "r", encoding="utf-8") as f:
+            store = json.load(f)
+    except (OSError, ValueError) as e:
+        print("AVISO: no se pudo leer", PARTIALS_PATH, "-", e)
+        return {}
+    for entry in store.values():
+        if entry["item"].get("partial"):
+            entry["item"]["partial"] = sketch.from_json(entry["item"]["partial"])
+    return store
+
+
+# Writes the partial results to a temporary file first so it is never half written
+def save_partials(store: dict):
+    tmp_path = PARTIALS_PATH + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(store, f)
+    os.replace(tmp_path, PARTIALS_PATH)
+
+
+# Like process_sources, but files whose fingerprint is in the store reuse the
+# stored result and only new or changed files are read. The store is rewritten
+# with the current sources only, so results of deleted files are dropped.
+# The cube cells are not stored here (they are in the cube database), but the
+# entry remembers if they were made, so with use_cube a file that was processed
+# without --cube before is read again.
+def process_sources_incremental(sources: list[tuple], chunksize: int = 0, workers: int = 1,
+                                use_cache: bool = False, use_cube: bool = False) -> list[dict]:
+    store = load_partials()
+    fingerprints = {source_key(path, member): source_fingerprint(path) for _, path, member in sources}
+
+    def is_current(key: str) -> bool:
+        entry = store.get(key, {})
+        return entry.get("fingerprint") == fingerprints[key] and (entry.get("cube") or not use_cube)
+
+    todo = [s for s in sources if not is_current(source_key(s[1], s[2]))]
+    print(f"Incremental: {len(sources) - len(todo)} ficheros sin cambios, {len(todo)} nuevos o modificados")
+
+    new_items = {source_key(s[1], s[2]): item
+                 for s, item in zip(todo, process_sources(todo, chunksize, workers, use_cache, use_cube))}
+
+    results = []
+    new_store = {}
+    for _, path, member in sources:
+        key = source_key(path, member)
+        if key in new_items:
+            item = new_items[key]
+            has_cube = "cube" in item
+        else:
+            item = store[key]["item"]
+            has_cube = store[key].get("cube", False)
+        results.append(item)
+        # Errors are not stored, the file is tried again next time
+        if "error" not in item:
+            stored_item = {k: v for k, v in item.items() if k != "cube"}
+            new_store[key] = {"fingerprint": fingerprints[key], "cube": has_cube, "item": stored_item}
+
+    save_partials(new_store)
+    return results
+
+
+# Write the cube cells of the files that were read in this run. Files reused
+# by --incremental keep their rows, and rows of files that are gone are deleted.
+def save_cube(items: list[dict]):
+    conn = cube.connect()
+    try:
+        cube.drop_missing_sources(conn, [item["file"] for item in items])
+        updated = 0
+        for item in items:
+            if item.get("cube") is not None:
+                cube.save_source(conn, item["file"], item["cube"])
+                updated += 1
+        print(f"Cubo: {updated} ficheros actualizados en {cube.CUBE_DB}")
+    finally:
+        conn.close()
+
+
 def main():
     # Check that the downloads folder exists
     if not os.path.isdir(DOWNLOAD_DIR):
@@ -114,62 +623,65 @@ def main():
     # Create processed if it does not exist
     os.makedirs(PROCESSED_DIR, exist_ok=True)
 
-    results = []
+    # --from-zip: read the CSVs directly from the zips, nothing is extracted
+    from_zip = "--from-zip" in sys.argv
+    # --stream / --chunksize N: read each file in chunks with bounded memory
+    chunksize = get_int_arg("--chunksize", CHUNK_ROWS if "--stream" in sys.argv else 0)
+    # --workers N: process N files at the same time, one process each
+    workers = get_int_arg("--workers", 1)
+    # --cache: keep a Parquet copy of each file so the next runs skip the CSV
+    use_cache = "--cache" in sys.argv
+    if use_cache and pa is None:
+        print("AVISO: --cache necesita pyarrow (pip install pyarrow), se ejecuta sin cache")
+        use_cache = False
+    # --incremental: only read files that are new or changed since the last run
+    incremental = "--incremental" in sys.argv
+    # --cube: also build the trips by date and hour in processed/divvy_cube.sqlite
+    use_cube = "--cube" in sys.argv
 
-    # Read all CSV files in downloads
-    for file in os.listdir(DOWNLOAD_DIR):
-        if not file.lower().endswith(".csv"):
+    results = []
+    # All files together, to show that the summaries can be merged
+    overall = sketch.new_sketch()
+
+    # Read all CSV files in downloads (or inside its zips)
+    sources = list_sources(from_zip)
+    if use_cache:
+        clean_cache(sources)
+    if incremental:
+        items = process_sources_incremental(sources, chunksize, workers, use_cache, use_cube)
+    else:
+        items = process_sources(sources, chunksize, workers, use_cache, use_cube)
+    if use_cube:
+        save_cube(items)
+    for item in items:
+        file = item["file"]
+        if "error" in item:
+            print(f"Error en {file}: {item['error']}")
             continue
 
-        path = os.path.join(DOWNLOAD_DIR, file)
-        df = pd.read_csv(path, low_memory=False)
-
         # Calculate mean trip duration in minutes
-        if "tripduration" in df.columns:
-            duration_min = pd.to_numeric(df["tripduration"], errors="coerce") / 60
-
-        elif "01 - Rental Details Duration In Seconds Uncapped" in df.columns:
-            # Q2 doen't have tripduration, but has this other column in seconds
-            duration_sec = (
-                df["01 - Rental Details Duration In Seconds Uncapped"]
-                .astype(str)
-                .str.replace(",", "", regex=False)
-            )
-            duration_min = pd.to_numeric(duration_sec, errors="coerce") / 60
-
-        #some Q files dont have tripduration, have started_at and ended_at columns
-        elif "started_at" in df.columns and "ended_at" in df.columns:
-            start = pd.to_datetime(df["started_at"], errors="coerce")
-            end = pd.to_datetime(df["ended_at"], errors="coerce")
-            duration_min = (end - start).dt.total_seconds() / 60
-
-        else:
+        partial = item["partial"]
+        if partial is None:
             # If there is no way to calculate duration, we skip the file.
             print(f"Saltando {file}: no se puede calcular la duración (faltan columnas)")
             continue
 
-        # Clean nulls
-        duration_min = duration_min.dropna()
-
-        # Remove invalid values
-        duration_min = duration_min[(duration_min >= 0) & (duration_min <= 24 * 60)]
-
-        if duration_min.empty:
+        if partial["count"] == 0:
             print(f"Saltando {file}: duración vacía tras limpiar datos")
             continue
 
-        mean_minutes = duration_min.mean()
-
-        year, quarter = get_year_quarter(file)
+        mean_minutes = partial["sum"] / partial["count"]
+        overall = sketch.merge(overall, partial)
 
         results.append({
-            "year": year,
-            "quarter": quarter,
+            "year": item["year"],
+            "quarter": item["quarter"],
             "mean_trip_time_minutes": mean_minutes,
-            "file": file
+            "file": file,
+            **duration_stats(partial),
         })
 
-        print(f"OK {file} -> mean = {mean_minutes:.2f} min")
+        print(f"OK {file} -> mean = {mean_minutes:.2f} min, p50 = {results[-1]['p50_trip_time_minutes']:.2f} min")
 
     # Save results to CSV in processed
     out = pd.DataFrame(results)
@@ -184,6 +696,11 @@ def main():
     print("\nGuardado:", OUTPUT_PATH)
     print(out.to_string(index=False))
 
+    if overall["count"]:
+        stats = duration_stats(overall)
+        print(f"\nTotal: {stats['trip_count']} viajes, p50 = {stats['p50_trip_time_minutes']:.2f} min, "
+              f"p90 = {stats['p90_trip_time_minutes']:.2f} min, p99 = {stats['p99_trip_time_minutes']:.2f} min")
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,120 @@
+import math
+import numpy as np
+
+# One-pass summary of trip durations that can be merged: count, sum, mean,
+# std, min, max and a quantile sketch for p50/p90/p99.
+#
+# The quantile sketch puts every value x > 0 in a bucket k = ceil(log_gamma(x)),
+# with gamma = (1 + a) / (1 - a), and keeps only the number of values per bucket.
+# Zeros have their own counter. Two sketches are merged by adding the counts of
+# the same bucket, so the result does not depend on how the data was split in
+# chunks, files or worker processes.
+#
+# Error bound: a quantile returned by quantile() is within a relative error of
+# RELATIVE_ACCURACY (1%) of the real value at that rank (for example a real p99
+# of 60 min is reported between 59.4 and 60.6 min). The rank is the lower one,
+# q * (count - 1) rounded down, so it can differ from pandas .quantile(), which
+# interpolates between the two nearest values. count, sum, mean, min and max are
+# exact; std is exact up to floating point (merged with Chan's formula).
+# Memory: one counter per bucket used, about 570 buckets from 1 second to 24 hours.
+
+RELATIVE_ACCURACY = 0.01
+GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+LOG_GAMMA = math.log(GAMMA)
+
+
+# Empty summary
+def new_sketch() -> dict:
+    return {
+        "count": 0,
+        "sum": 0.0,
+        "mean": 0.0,
+        "m2": 0.0,  # sum of squared differences to the mean (for std)
+        "min": None,
+        "max": None,
+        "zeros": 0,
+        "buckets": {},
+    }
+
+
+# Add the values of one chunk (non-negative numbers, no NaN) to the summary
+def add_values(sketch: dict, values) -> dict:
+    values = np.asarray(values, dtype="float64")
+    if values.size == 0:
+        return sketch
+
+    chunk_mean = float(values.mean())
+    chunk = {
+        "count": int(values.size),
+        "sum": float(values.sum()),
+        "mean": chunk_mean,
+        "m2": float(((values - chunk_mean) ** 2).sum()),
+        "min": float(values.min()),
+        "max": float(values.max()),
+    }
+
+    positive = values[values > 0]
+    chunk["zeros"] = int(values.size - positive.size)
+    keys, counts = np.unique(np.ceil(np.log(positive) / LOG_GAMMA).astype(np.int64), return_counts=True)
+    chunk["buckets"] = dict(zip(keys.tolist(), counts.tolist()))
+
+    merged = merge(sketch, chunk)
+    sketch.update(merged)
+    return sketch
+
+
+# Combine two summaries into a new one
+def merge(a: dict, b: dict) -> dict:
+    if a["count"] == 0:
+        return {**b, "buckets": dict(b["buckets"])}
+    if b["count"] == 0:
+        return {**a, "buckets": dict(a["buckets"])}
+
+    count = a["count"] + b["count"]
+    delta = b["mean"] - a["mean"]
+    buckets = dict(a["buckets"])
+    for k, c in b["buckets"].items():
+        buckets[k] = buckets.get(k, 0) + c
+
+    return {
+        "count": count,
+        "sum": a["sum"] + b["sum"],
+        "mean": a["mean"] + delta * b["count"] / count,
+        "m2": a["m2"] + b["m2"] + delta * delta * a["count"] * b["count"] / count,
+        "min": min(a["min"], b["min"]),
+        "max": max(a["max"], b["max"]),
+        "zeros": a["zeros"] + b["zeros"],
+        "buckets": buckets,
+    }
+
+
+# Approximate value at quantile q (0 <= q <= 1), see the error bound above
+def quantile(sketch: dict, q: float) -> float:
+    if sketch["count"] == 0:
+        return math.nan
+
+    rank = int(q * (sketch["count"] - 1))
+    seen = sketch["zeros"]
+    if rank < seen:
+        return 0.0
+
+    for k in sorted(sketch["buckets"]):
+        seen += sketch["buckets"][k]
+        if rank < seen:
+            # middle of the bucket (GAMMA^(k-1), GAMMA^k] in relative terms
+            value = 2 * GAMMA ** k / (GAMMA + 1)
+            return min(max(value, sketch["min"]), sketch["max"])
+    return sketch["max"]
+
+
+# Sample standard deviation (like pandas .std())
+def std(sketch: dict) -> float:
+    if sketch["count"] < 2:
+        return math.nan
+    return math.sqrt(sketch["m2"] / (sketch["count"] - 1))
+
+
+
+# JSON keys are strings, turn the bucket keys back into integers
+def from_json(data: dict) -> dict:
+    return {**data, "buckets": {int(k): c for k, c in data["buckets"].items()}}
@@ -1,14 +1,56 @@
 import os
 import sys
+import glob
+import json
+import time
+import signal
 import shutil
+import sqlite3
+import hashlib
 import logging
+import threading
+import statistics
 import subprocess
+import importlib.util
+from collections import deque
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# resource and os.wait4 are POSIX only: on Windows the steps run the same but
+# their CPU time and peak memory are not recorded (None in the run history)
+try:
+    import resource
+except ImportError:
+    resource = None
 
 LOG_DIR = "logs"
 LOG_FILE = os.path.join(LOG_DIR, "pipeline.log")
 ALERTS_LOG = os.path.join("logs", "alerts.log")
 
+# One JSON line per step and run with wall time, CPU time, peak memory and
+# rows in/out (python run_pipeline.py --report compares the latest run of each
+# step with the previous ones). It is in logs so --clean does not delete it.
+RUN_HISTORY = os.path.join(LOG_DIR, "run_history.jsonl")
+# Previous successful runs used as reference in the report (their median)
+HISTORY_RUNS = 10
+# A metric is flagged when it is this much worse than the reference
+# and the difference is bigger than the noise of a short run
+REGRESSION_LIMIT = 0.20
+NOISE_FLOOR = {"wall_s": 0.2, "cpu_s": 0.2, "peak_rss_mb": 10}
+
+# Output of a subprocess step is logged line by line while it runs. Only the
+# last STDERR_TAIL_LINES lines of stderr are kept (for the alert), and longer
+# lines than MAX_LINE_CHARS are logged in pieces, so memory stays bounded.
+STDERR_TAIL_LINES = 20
+MAX_LINE_CHARS = 8192
+# Seconds between "still running" messages of a long step
+HEARTBEAT_SECONDS = 30
+# A subprocess step running longer than this is stopped (--timeout N, 0 = no limit)
+STEP_TIMEOUT = 3600
+# Seconds to wait for the last output of a step after it exited or was stopped
+# (a process it started could still hold its stdout/stderr open)
+READER_JOIN_SECONDS = 5
+
 PROCESSED_DIR = os.path.join("data", "processed")
 WAREHOUSE_DB = os.path.join("data", "warehouse", "music_dw.sqlite")
 
@@ -16,6 +58,41 @@ INGEST_SCRIPT = os.path.join("src", "ingest.py")
 TRANSFORM_SCRIPT = os.path.join("src", "processing", "transform.py")
 LOAD_DW_SCRIPT = os.path.join("src", "warehouse", "load_dw.py")
 
+# Inputs and outputs can be glob patterns (raw sources can have many partitions)
+RAW_FILES = [os.path.join("data", "raw", "**", "*.csv")]
+# Written by ingest with the types of the raw columns, read by transform
+RAW_PROFILE = os.path.join("data", "raw_profile.json")
+GENRE_MAPPING = os.path.join("config", "genre_mapping.json")
+CLEANING_RULES = os.path.join("config", "cleaning_rules.json")
+# Arrow IPC copies of the raw files (ingest) and of the processed tables
+# (transform), read memory-mapped by the next steps when pyarrow is installed
+STAGING_DIR = os.path.join("data", "staging")
+RAW_STAGING = os.path.join(STAGING_DIR, "raw", "**", "*.arrow")
+PROCESSED_FILES = [
+    os.path.join(PROCESSED_DIR, "music_features_by_genre.csv"),
+    os.path.join(PROCESSED_DIR, "mental_health_by_genre.csv"),
+    os.path.join(STAGING_DIR, "processed", "*.arrow"),
+]
+# Data quality tables of transform (not used by load_dw)
+RULE_VIOLATIONS = [os.path.join(PROCESSED_DIR, "*_rule_violations.csv")]
+
+# Hashes of the inputs, code and outputs of the last successful run of each step.
+# A step whose hashes did not change is skipped (--force STEP runs it anyway).
+RUN_MANIFEST = os.path.join("data", "run_manifest.json")
+
+# Steps in order. The outputs of a step are the inputs of the next ones, so
+# when a step writes different outputs only the steps after it run again.
+STEPS = [
+    {"name": "ingest", "script": INGEST_SCRIPT, "inputs": RAW_FILES, "outputs": [RAW_PROFILE, RAW_STAGING]},
+    {"name": "transform", "script": TRANSFORM_SCRIPT, "inputs": RAW_FILES + [RAW_PROFILE, RAW_STAGING, GENRE_MAPPING, CLEANING_RULES],
+     "outputs": PROCESSED_FILES + RULE_VIOLATIONS},
+    {"name": "load_dw", "script": LOAD_DW_SCRIPT, "inputs": PROCESSED_FILES, "outputs": [WAREHOUSE_DB]},
+]
+STEP_BY_NAME = {step["name"]: step for step in STEPS}
+
+# Tasks that run at the same time in --in-process mode (--workers N)
+MAX_WORKERS = 4
+
 
 # Ensure the logs directory exists
 def ensure_logs_dir():
@@ -43,28 +120,545 @@ def write_alert(step_name: str, message: str):
     logging.error("ALERT: %s", alert_text.strip())
 
 
-# Run a pipeline step as a subprocess and check for errors
-def run_step(name: str, cmd: list[str]):
+# Log the lines of one output pipe of a step as they come. tail (if given)
+# keeps the last lines, state["last_output"] the time of the last line.
+def pump_lines(pipe, log, name: str, state: dict, tail: deque = None):
+    for line in iter(lambda: pipe.readline(MAX_LINE_CHARS), ""):
+        line = line.rstrip("\n")
+        state["last_output"] = time.monotonic()
+        log(f"[{name}] {line}")
+        if tail is not None:
+            tail.append(line)
+    pipe.close()
+
+
+# Run a pipeline step as a subprocess and check for errors.
+# Its stdout and stderr go to the log while it runs, with a heartbeat every
+# HEARTBEAT_SECONDS, and it is stopped after timeout seconds (None or 0: no limit).
+# Returns the CPU time and peak memory of the subprocess.
+def run_step(name: str, cmd: list[str], timeout: float = STEP_TIMEOUT) -> dict:
     logging.info(f"Running step: {name} ")
 
-    result = subprocess.run(cmd, capture_output=True, text=True)
+    # unbuffered, so print() lines of the step arrive when they are printed
+    env = {**os.environ, "PYTHONUNBUFFERED": "1"}
+    # in its own process group, so a timeout also stops the processes it started
+    # (the worker processes of ingest)
+    if os.name == "nt":
+        group = {"creationflags": subprocess.CREATE_NEW_PROCESS_GROUP}
+    else:
+        group = {"start_new_session": True}
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True,
+                            encoding="utf-8", errors="replace", env=env, **group)
+
+    state = {"last_output": time.monotonic()}
+    stderr_tail = deque(maxlen=STDERR_TAIL_LINES)
+    readers = [
+        threading.Thread(target=pump_lines, args=(proc.stdout, logging.info, name, state), daemon=True),
+        threading.Thread(target=pump_lines, args=(proc.stderr, logging.warning, name, state, stderr_tail),
+                         daemon=True),
+    ]
+    for reader in readers:
+        reader.start()
+
+    # wait4 instead of proc.wait(), it also gives the resource usage of this child
+    exit_info = {}
+    if hasattr(os, "wait4"):
+        waiter = threading.Thread(target=lambda: exit_info.update(zip(("pid", "status", "usage"),
+                                                                      os.wait4(proc.pid, 0))), daemon=True)
+    else:
+        waiter = threading.Thread(target=proc.wait, daemon=True)
+    waiter.start()
 
-    # Log standard output if present
-    if result.stdout:
-        logging.info(result.stdout)
+    start = time.monotonic()
+    timed_out = False
+    try:
+        while True:
+            wait_s = HEARTBEAT_SECONDS
+            if timeout:
+                wait_s = min(wait_s, max(0.0, start + timeout - time.monotonic()))
+            waiter.join(wait_s)
+            if not waiter.is_alive():
+                break
 
-    # Log errors if present
-    if result.stderr:
-        logging.warning(result.stderr)
+            now = time.monotonic()
+            if timeout and now - start >= timeout:
+                logging.error(f"Step {name} did not finish in {timeout}s, stopping it")
+                timed_out = True
+                kill_process_group(proc)
+                waiter.join()
+                break
+            logging.info(f"Step {name} still running ({now - start:.0f}s, "
+                         f"last output {now - state['last_output']:.0f}s ago)")
+    except KeyboardInterrupt:
+        # the step is not in the group of the terminal, Ctrl+C does not reach it
+        kill_process_group(proc)
+        raise
+
+    for reader in readers:
+        reader.join(READER_JOIN_SECONDS)
+        if reader.is_alive():
+            logging.warning(f"Output of step {name} still open after it exited, not waiting for it")
+    usage = exit_info.get("usage")
+    if usage is not None:
+        proc.returncode = os.waitstatus_to_exitcode(exit_info["status"])
 
     # Stop the pipeline if the step failed
-    if result.returncode != 0:
-        err_msg = result.stderr.strip() if result.stderr else f"Exit code {result.returncode}"
+    if timed_out or proc.returncode != 0:
+        err_msg = "\n".join(stderr_tail).strip() or f"Exit code {proc.returncode}"
+        if timed_out:
+            err_msg = f"Timeout after {timeout}s\n{err_msg}"
         write_alert(name, err_msg)
-        raise SystemExit(result.returncode)
+        raise SystemExit(proc.returncode if proc.returncode > 0 else 1)
+
+
+    logging.info(f"Step finished successfully: {name}")
+    if usage is None:
+        return {"cpu_s": None, "peak_rss_mb": None}
+    return {"cpu_s": usage.ru_utime + usage.ru_stime, "peak_rss_mb": rss_mb(usage.ru_maxrss)}
+
+
+# Stop a step and every process of its group (see run_step)
+def kill_process_group(proc: subprocess.Popen):
+    if os.name == "nt":
+        # /T: the whole tree of processes started by the step
+        if subprocess.run(["taskkill", "/F", "/T", "/PID", str(proc.pid)], capture_output=True).returncode:
+            proc.kill()
+    else:
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+
+# ru_maxrss is in kilobytes on Linux and in bytes on macOS
+def rss_mb(maxrss: int) -> float:
+    return maxrss / (1024 * 1024) if sys.platform == "darwin" else maxrss / 1024
+
+
+# Number of rows of a step input or output: lines minus the header for CSVs,
+# rows of all tables for the SQLite warehouse. None if the file does not exist
+# or is another kind of file (the staging copies are not counted twice).
+def count_rows(path: str):
+    if not os.path.exists(path) or not path.endswith((".csv", ".sqlite")):
+        return None
+    if path.endswith(".sqlite"):
+        conn = sqlite3.connect(path)
+        try:
+            tables = [t for (t,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table';")
+                      if not t.startswith("sqlite_")]
+            return sum(conn.execute(f'SELECT COUNT(*) FROM "{t}";').fetchone()[0] for t in tables)
+        finally:
+            conn.close()
+    lines = 0
+    last = b"\n"
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            lines += block.count(b"\n")
+            last = block[-1:]
+    # the last line may not end with a newline
+    if last != b"\n":
+        lines += 1
+    return max(lines - 1, 0)
+
+
+# Total rows of a list of files (None if none of them exists)
+def count_rows_files(paths: list[str]):
+    counts = [c for c in (count_rows(path) for path in paths) if c is not None]
+    return sum(counts) if counts else None
+
+
+# Append one record to the run history
+def append_history(record: dict):
+    os.makedirs(LOG_DIR, exist_ok=True)
+    with open(RUN_HISTORY, "a", encoding="utf-8") as f:
+        f.write(json.dumps(record) + "\n")
+
+
+# Run a step (func) and save its metrics in the run history, also when it fails.
+# In subprocess mode func is run_step, which gives the CPU time and peak memory
+# of the child. In-process the CPU time is the one of this process during the
+# step (all its threads) and the peak memory is the high-water mark of this
+# process, so it includes the steps before.
+def run_measured(step: dict, run: dict, func, *args, **kwargs):
+    record = {
+        "run_id": run["run_id"],
+        "mode": run["mode"],
+        "step": step["name"],
+        "started_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "status": "failed",
+        "rows_in": count_rows_files(expand_paths(step["inputs"])),
+    }
+    start_wall = time.perf_counter()
+    start_cpu = time.process_time()
+    result = None
+    try:
+        result = func(*args, **kwargs)
+        record["status"] = "ok"
+        return result
+    finally:
+        record["wall_s"] = time.perf_counter() - start_wall
+        if run["mode"] == "in-process":
+            record["cpu_s"] = time.process_time() - start_cpu
+            record["peak_rss_mb"] = (rss_mb(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+                                     if resource is not None else None)
+        elif record["status"] == "ok":
+            record.update(result)
+        if record["status"] == "ok":
+            record["rows_out"] = count_rows_files(expand_paths(step["outputs"]))
+        append_history(record)
+
+
+# Steps that are skipped are in the history too, without metrics
+def record_skipped(step: dict, run: dict):
+    append_history({
+        "run_id": run["run_id"],
+        "mode": run["mode"],
+        "step": step["name"],
+        "started_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "status": "skipped",
+    })
+
+
+# Read the run history (one dict per line, broken lines are ignored)
+def load_history() -> list[dict]:
+    if not os.path.exists(RUN_HISTORY):
+        return []
+    records = []
+    with open(RUN_HISTORY, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue
+    return records
+
+
+# Compare the latest non-skipped run of each step with the median of its earlier
+# successful runs in the same mode. Prints a table and returns the regressions.
+def report() -> list[dict]:
+    history = load_history()
+    if not history:
+        print(f"No runs in {RUN_HISTORY} yet")
+        return []
+
+    # A run where nothing changed only has "skipped" records: use the latest run
+    # of each step that actually did the work
+    latest = []
+    for step in dict.fromkeys(r["step"] for r in history):
+        runs = [i for i, r in enumerate(history) if r["step"] == step and r["status"] != "skipped"]
+        if runs:
+            latest.append(runs[-1])
+    if not latest:
+        print(f"Every step was skipped in the runs of {RUN_HISTORY}")
+        return []
+
+    print(f"Latest run of each step against the median of up to {HISTORY_RUNS} earlier runs\n")
+    print(f"{'step':<12}{'run':<24}{'mode':<12}{'status':<9}{'wall_s':>16}{'cpu_s':>16}{'peak_rss_mb':>18}"
+          f"{'rows_in':>10}{'rows_out':>10}")
+
+    regressions = []
+    for index in latest:
+        record = history[index]
+        previous = [r for r in history[:index]
+                    if r["run_id"] != record["run_id"] and r["step"] == record["step"]
+                    and r["mode"] == record["mode"] and r["status"] == "ok"][-HISTORY_RUNS:]
+
+        cells = []
+        for metric, width in (("wall_s", 16), ("cpu_s", 16), ("peak_rss_mb", 18)):
+            value = record.get(metric)
+            if value is None:
+                cells.append(f"{'-':>{width}}")
+                continue
+            values = [r[metric] for r in previous if r.get(metric) is not None]
+            if not values:
+                cells.append(f"{value:>{width}.2f}")
+                continue
+            reference = statistics.median(values)
+            mark = ""
+            if value > reference * (1 + REGRESSION_LIMIT) and value - reference > NOISE_FLOOR[metric]:
+                mark = "!"
+                regressions.append({"step": record["step"], "metric": metric,
+                                    "value": value, "reference": reference})
+            cells.append(f"{f'{value:.2f} ({reference:.2f}){mark}':>{width}}")
+
+        rows = "".join(f"{'-' if record.get(k) is None else record[k]:>10}" for k in ("rows_in", "rows_out"))
+        print(f"{record['step']:<12}{record['run_id']:<24}{record['mode']:<12}{record['status']:<9}"
+              f"{''.join(cells)}{rows}")
+
+    print()
+    for r in regressions:
+        change = r["value"] / r["reference"] - 1 if r["reference"] else float("inf")
+        print(f"REGRESSION {r['step']} {r['metric']}: {r['reference']:.2f} -> {r['value']:.2f} ({change:+.0%})")
+    if not regressions:
+        print("No regressions")
+    return regressions
+
+
+# Import a step script as a module (the scripts are not a package), so its
+# run() function can be called in this process
+def load_step_module(path: str):
+    # Registered under its file name with its folder on sys.path, like a normal
+    # import, so worker processes started with spawn (Windows, macOS) can import
+    # it again to run its functions (ingest validates files on a process pool)
+    module_name = os.path.splitext(os.path.basename(path))[0]
+    script_dir = os.path.dirname(os.path.abspath(path))
+    if script_dir not in sys.path:
+        sys.path.insert(0, script_dir)
+    spec = importlib.util.spec_from_file_location(module_name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[module_name] = module
+    try:
+        spec.loader.exec_module(module)
+    except BaseException:
+        del sys.modules[module_name]
+        raise
+    return module
 
 
+# Call a function of a step and return its result. If it fails the error goes
+# to the alerts log and the pipeline stops, like a failed subprocess in run_step.
+def run_guarded(name: str, func, *args, **kwargs):
+    try:
+        return func(*args, **kwargs)
+    except (Exception, SystemExit) as e:
+        write_alert(name, f"{type(e).__name__}: {e}")
+        raise SystemExit(1)
+
+
+# Run a pipeline step in this process: import its script and call its run()
+# function with the given arguments, returning the result.
+# Same logs and alerts as run_step, but there is no new interpreter and
+# DataFrames are passed to the next step in memory.
+def run_step_in_process(name: str, script: str, *args, **kwargs):
+    logging.info(f"Running step: {name} (in-process)")
+    result = run_guarded(name, lambda: load_step_module(script).run(*args, **kwargs))
     logging.info(f"Step finished successfully: {name}")
+    return result
+
+
+# One task of run_tasks, called with the results of its deps
+def run_task(name: str, task: dict, results: dict):
+    logging.info(f"Running task: {name}")
+    result = run_guarded(name, task["run"], *[results[dep] for dep in task["deps"]])
+    logging.info(f"Task finished successfully: {name}")
+    return result
+
+
+# Run a small DAG of tasks on a thread pool. tasks maps a name to
+# {"deps": [names], "run": function}; run gets the results of its deps as
+# arguments. A task starts as soon as all its deps are done, so independent
+# branches run at the same time and the wall time is the longest branch.
+# If a task fails no new task is started and the pipeline stops.
+def run_tasks(tasks: dict, workers: int = MAX_WORKERS) -> dict:
+    results = {}
+    pending = dict(tasks)
+    running = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while pending or running:
+            for name, task in list(pending.items()):
+                if all(dep in results for dep in task["deps"]):
+                    del pending[name]
+                    running[pool.submit(run_task, name, task, results)] = name
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                results[running.pop(future)] = future.result()
+    return results
+
+
+# Transform as two independent branches: music and survey
+# (chunksize: rows read at a time, None for whole files; survey_mode: ""
+# "incremental" or "full-rebuild", see transform.py)
+def transform_tasks(save_csv: bool, chunksize: int = None, survey_mode: str = "") -> dict:
+    transform = run_guarded("transform", load_step_module, TRANSFORM_SCRIPT)
+    return {
+        "transform:music": {"deps": [], "run": lambda: transform.run_music(save=save_csv, chunksize=chunksize)},
+        "transform:survey": {"deps": [], "run": lambda: transform.run_survey(
+            save=save_csv, chunksize=chunksize, incremental=survey_mode == "incremental",
+            full_rebuild=survey_mode == "full-rebuild")},
+    }
+
+
+# Warehouse load: dim_genre first, then the fact tables one after the other
+# (SQLite has a single writer).
+# Without DataFrames from transform (it was skipped) the processed CSVs are read.
+def load_dw_tasks(music_by_genre, mental_by_genre) -> dict:
+    load_dw = run_guarded("load_dw", load_step_module, LOAD_DW_SCRIPT)
+    if music_by_genre is None or mental_by_genre is None:
+        music_by_genre, mental_by_genre = run_guarded("load_dw", load_dw.read_processed)
+    return {
+        "load_dw:dim_genre": {
+            "deps": [],
+            "run": lambda: load_dw.build_dim(music_by_genre, mental_by_genre),
+        },
+        "load_dw:music_facts": {
+            "deps": ["load_dw:dim_genre"],
+            "run": lambda ids: load_dw.load_facts(load_dw.load_music_facts, music_by_genre, ids),
+        },
+        # after music_facts: both write to the same SQLite file
+        "load_dw:mental_facts": {
+            "deps": ["load_dw:dim_genre", "load_dw:music_facts"],
+            "run": lambda ids, _: load_dw.load_facts(load_dw.load_mental_facts, mental_by_genre, ids),
+        },
+    }
+
+
+# Whole pipeline in one process: ingest -> transform -> load_dw, with the
+# independent tasks of each step running at the same time (see run_tasks).
+# The processed CSVs are still written (Looker Studio reads them) unless
+# save_csv is False, but load_dw uses the DataFrames from transform directly
+# (or reads the CSVs if transform was skipped). Without the CSVs transform
+# has no outputs to check, so it is never skipped.
+def run_in_process(manifest: dict, forced: set, run: dict, save_csv: bool = True,
+                   workers: int = MAX_WORKERS, chunksize: int = None, survey_mode: str = ""):
+    # 1: Ingestion
+    step = STEP_BY_NAME["ingest"]
+    fingerprint = step_fingerprint(step)
+    if os.path.exists(INGEST_SCRIPT):
+        if should_run(step, manifest, fingerprint, forced):
+            run_measured(step, run, run_step_in_process, "ingest", INGEST_SCRIPT)
+            record_step(step, manifest, fingerprint)
+        else:
+            record_skipped(step, run)
+
+    # 2: Transform
+    music_by_genre, mental_by_genre = None, None
+    step = STEP_BY_NAME["transform"]
+    fingerprint = step_fingerprint(step)
+    if should_run(step, manifest, fingerprint, forced):
+        results = run_measured(step, run, lambda: run_tasks(transform_tasks(save_csv, chunksize, survey_mode), workers))
+        music_by_genre, mental_by_genre = results["transform:music"], results["transform:survey"]
+        if save_csv:
+            record_step(step, manifest, fingerprint)
+    else:
+        record_skipped(step, run)
+
+    # 3: Load data into the Data Warehouse (SQLite)
+    step = STEP_BY_NAME["load_dw"]
+    fingerprint = step_fingerprint(step)
+    if music_by_genre is not None and not save_csv:
+        # the inputs are in memory, there are no files to compare
+        forced = forced | {"load_dw"}
+    if should_run(step, manifest, fingerprint, forced):
+        run_measured(step, run, lambda: run_tasks(load_dw_tasks(music_by_genre, mental_by_genre), workers))
+        if save_csv:
+            record_step(step, manifest, fingerprint)
+    else:
+        record_skipped(step, run)
+
+
+# Files of a list of paths and glob patterns. A pattern that matches nothing
+# adds nothing (for example the staging files without pyarrow), a plain path
+# is always kept, so it shows up as a missing file.
+def expand_paths(paths: list[str]) -> list[str]:
+    files = []
+    for path in paths:
+        files += sorted(glob.glob(path, recursive=True)) if glob.has_magic(path) else [path]
+    return files
+
+
+# sha256 of a file, None if it does not exist
+def hash_file(path: str):
+    if not os.path.exists(path):
+        return None
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+# Reads the run manifest (empty if there is none or it is broken)
+def load_manifest() -> dict:
+    if not os.path.exists(RUN_MANIFEST):
+        return {}
+    try:
+        with open(RUN_MANIFEST, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        logging.warning(f"Could not read {RUN_MANIFEST}, all steps will run: {e}")
+        return {}
+
+
+# Writes the manifest to a temporary file first so it is never half written
+def save_manifest(manifest: dict):
+    os.makedirs(os.path.dirname(RUN_MANIFEST), exist_ok=True)
+    tmp_path = RUN_MANIFEST + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, RUN_MANIFEST)
+
+
+# Hashes of what a step reads: its input files and its own script
+def step_fingerprint(step: dict) -> dict:
+    return {
+        "code": hash_file(step["script"]),
+        "inputs": {path: hash_file(path) for path in expand_paths(step["inputs"])},
+    }
+
+
+# Decide if a step has to run. It is skipped when it is not forced, its inputs
+# and code have the same hashes as in its last successful run and its outputs
+# are still the ones it wrote. If it runs, its entry is removed first, so a
+# failed run is never taken as up to date.
+def should_run(step: dict, manifest: dict, fingerprint: dict, forced: set) -> bool:
+    name = step["name"]
+    entry = manifest.get(name)
+
+    if name in forced:
+        reason = "forced"
+    elif entry is None:
+        reason = "no previous run"
+    elif entry["code"] != fingerprint["code"]:
+        reason = "code changed"
+    elif entry["inputs"] != fingerprint["inputs"] or None in fingerprint["inputs"].values():
+        reason = "inputs changed"
+    elif any(hash_file(path) != digest for path, digest in entry["outputs"].items()):
+        reason = "outputs missing or modified"
+    else:
+        logging.info(f"Skipping step: {name} (inputs, code and outputs unchanged)")
+        return False
+
+    logging.info(f"Step {name} will run: {reason}")
+    if manifest.pop(name, None) is not None:
+        save_manifest(manifest)
+    return True
+
+
+# Save the hashes of a step that finished successfully
+def record_step(step: dict, manifest: dict, fingerprint: dict):
+    manifest[step["name"]] = {
+        **fingerprint,
+        "outputs": {path: hash_file(path) for path in expand_paths(step["outputs"])},
+        "finished_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+    }
+    save_manifest(manifest)
+
+
+# Steps given with --force STEP (can be repeated, "all" forces every step)
+def get_forced_steps() -> set:
+    forced = set()
+    for i, arg in enumerate(sys.argv):
+        if arg == "--force" and i + 1 < len(sys.argv):
+            forced.add(sys.argv[i + 1])
+
+    if "all" in forced:
+        return set(STEP_BY_NAME)
+
+    unknown = forced - set(STEP_BY_NAME)
+    if unknown:
+        logging.error(f"Unknown step in --force: {sorted(unknown)}. Steps: {list(STEP_BY_NAME)}")
+        raise SystemExit(1)
+    return forced
+
+
+# Integer value of a command line option like --workers 4
+def get_int_arg(name: str, default: int) -> int:
+    if name in sys.argv:
+        i = sys.argv.index(name)
+        if i + 1 < len(sys.argv):
+            return int(sys.argv[i + 1])
+    return default
 
 
 # Delete derived outputs to avoid duplicated 
@@ -73,13 +667,26 @@ def clean_outputs():
     if os.path.exists(PROCESSED_DIR):
         shutil.rmtree(PROCESSED_DIR)
 
+    # Remove the Arrow staging files (will be regenerated)
+    if os.path.exists(STAGING_DIR):
+        shutil.rmtree(STAGING_DIR)
+
     # Remove Data Warehouse database (will be recreated)
     if os.path.exists(WAREHOUSE_DB):
         os.remove(WAREHOUSE_DB)
 
+    # Forget the previous runs, every step runs again
+    if os.path.exists(RUN_MANIFEST):
+        os.remove(RUN_MANIFEST)
+
 
 def main():
 
+    # --report: compare the latest run of each step with the previous ones (exit code 1 if
+    # there are regressions), nothing is run
+    if "--report" in sys.argv:
+        raise SystemExit(1 if report() else 0)
+
     ensure_logs_dir()
     setup_logging()
 
@@ -87,15 +694,53 @@ def main():
     if "--clean" in sys.argv:
         clean_outputs()
 
-    # 1: Ingestion 
-    if os.path.exists(INGEST_SCRIPT):
-        run_step("ingest", [sys.executable, INGEST_SCRIPT])
+    # Steps whose inputs, code and outputs did not change are skipped,
+    # --force STEP runs a step anyway
+    forced = get_forced_steps()
+    manifest = load_manifest()
 
-    # 2: Transform 
-    run_step("transform", [sys.executable, TRANSFORM_SCRIPT])
+    # --in-process: run the steps as functions in this process instead of one
+    # subprocess each (--no-csv: do not write the processed CSVs in this mode,
+    # --workers N: tasks that can run at the same time)
+    in_process = "--in-process" in sys.argv
+    # --chunksize N: transform reads and aggregates the raw files N rows at a
+    # time, the outputs are the same (see transform.py)
+    chunksize = get_int_arg("--chunksize", None)
+    # --incremental: transform only cleans the survey responses newer than the
+    # last run, --full-rebuild: all of them again (transform is not skipped)
+    survey_mode = ""
+    if "--full-rebuild" in sys.argv:
+        survey_mode = "full-rebuild"
+        forced = forced | {"transform"}
+    elif "--incremental" in sys.argv:
+        survey_mode = "incremental"
+    # Metrics of every step go to the run history with the id of this run
+    run = {"run_id": datetime.now().strftime("%Y%m%d-%H%M%S-%f"),
+           "mode": "in-process" if in_process else "subprocess"}
+    if in_process:
+        workers = max(1, get_int_arg("--workers", MAX_WORKERS))
+        run_in_process(manifest, forced, run, save_csv="--no-csv" not in sys.argv, workers=workers,
+                       chunksize=chunksize, survey_mode=survey_mode)
+        print("SUCCESS: pipeline finished")
+        return
 
-    #3: Load data into the Data Warehouse (SQLite)
-    run_step("load_dw", [sys.executable, LOAD_DW_SCRIPT])
+    # --timeout N: seconds a subprocess step can run before it is stopped
+    timeout = get_int_arg("--timeout", STEP_TIMEOUT)
+    for step in STEPS:
+        # 1: Ingestion, 2: Transform, 3: Load data into the Data Warehouse (SQLite)
+        if step["name"] == "ingest" and not os.path.exists(INGEST_SCRIPT):
+            continue
+        fingerprint = step_fingerprint(step)
+        if should_run(step, manifest, fingerprint, forced):
+            cmd = [sys.executable, step["script"]]
+            if step["name"] == "transform" and chunksize:
+                cmd += ["--chunksize", str(chunksize)]
+            if step["name"] == "transform" and survey_mode:
+                cmd += ["--" + survey_mode]
+            run_measured(step, run, run_step, step["name"], cmd, timeout)
+            record_step(step, manifest, fingerprint)
+        else:
+            record_skipped(step, run)
 
     print("SUCCESS: pipeline finished")
 
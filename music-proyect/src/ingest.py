@@ -1,21 +1,63 @@
 import os
+import re
+import glob
+import json
 import logging
+import logging.handlers
 import csv
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+
+# pandas and pyarrow are only needed for the Arrow staging copy of the raw files.
+# Without them the files are validated and profiled, and transform.py reads the CSVs.
+try:
+    import pandas as pd
+    import pyarrow.feather as feather
+except ImportError:
+    feather = None
 
 RAW_DIR = os.path.join("data", "raw")
 LOG_DIR = "logs"
 LOG_FILE = os.path.join(LOG_DIR, "ingest.log")
 
-REQUIRED_FILES = [
-    "dataset.csv",
-    "mxmh_survey_results.csv",
-]
+# Raw sources. Each one can be a single CSV or many partitions (for example
+# daily drops in data/raw/mxmh_survey_results/date=2024-01-01/part-0.csv):
+# every file that matches one of the patterns (relative to RAW_DIR, ** for any
+# folders) is part of the source, and transform.py reads them as one dataset.
+# required_columns are the minimum expected columns of every file of the source
+# (to detect if the CSV is incorrect).
+SOURCES = {
+    "music": {
+        "patterns": ["dataset.csv", "dataset/**/*.csv"],
+        "required_columns": ["filename", "label"],
+    },
+    "survey": {
+        "patterns": ["mxmh_survey_results.csv", "mxmh_survey_results/**/*.csv"],
+        "required_columns": ["Age", "Fav genre"],
+    },
+}
+
+# Arrow IPC (Feather v2, uncompressed) copy of every valid raw file, written once
+# here so the next steps open it memory-mapped instead of parsing the CSV again
+STAGING_DIR = os.path.join("data", "staging", "raw")
 
-# Minimum expected columns (to detect if the CSV is incorrect)
-REQUIRED_COLUMNS = {
-    "dataset.csv": ["filename", "label"],
-    "mxmh_survey_results.csv": ["Age", "Fav genre"],
+# Files are validated and profiled at the same time, one process each
+MAX_WORKERS = os.cpu_count() or 1
+
+# Profile of every raw file (rows, types, nulls, min/max, checksum). transform.py
+# reads the numeric dtypes from here instead of guessing them again.
+PROFILE_PATH = os.path.join("data", "raw_profile.json")
+
+# Values that pandas reads as NaN by default, so nulls are counted the same way
+NA_VALUES = {
+    "", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND",
+    "1.#QNAN", "<NA>", "N/A", "NA", "NULL", "NaN", "None", "n/a", "nan", "null",
 }
+# Only plain numbers are taken as numeric, anything else (spaces, "inf",
+# "1,000"...) makes the column text and transform.py reads it as before
+INT_PATTERN = re.compile(r"[+-]?\d+")
+FLOAT_PATTERN = re.compile(r"[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?")
+TYPE_ORDER = {"empty": 0, "int": 1, "float": 2, "str": 3}
 
 
 # If folders do not exist, create them
@@ -88,41 +130,235 @@ def validate_columns(csv_path: str, required_cols: list[str]) -> bool:
         return False
 
 
-def validate_all_files() -> bool:
+# Type of one non-null value: int, float or str
+def value_type(value: str) -> str:
+    if INT_PATTERN.fullmatch(value) and abs(int(value)) < 2 ** 63:
+        return "int"
+    if FLOAT_PATTERN.fullmatch(value):
+        return "float"
+    return "str"
+
+
+# Lines of a file as text while the sha256 of its bytes is calculated
+def hashed_lines(f, h):
+    for raw_line in f:
+        h.update(raw_line)
+        yield raw_line.decode("utf-8")
+
+
+# Profile a CSV in one pass, keeping only counters per column (memory does not
+# depend on the file size): rows, malformed rows (wrong number of fields),
+# and per column the inferred type, nulls and min/max of numeric columns, plus
+# the sha256 of the file. "dtype" is the pandas dtype transform.py can use to
+# read a numeric column (int64 without nulls, float64 otherwise).
+def profile_csv(csv_path: str) -> dict:
+    h = hashlib.sha256()
+    rows = 0
+    malformed = 0
+    with open(csv_path, "rb") as f:
+        reader = csv.reader(hashed_lines(f, h))
+        header = next(reader, [])
+        columns = [{"type": "empty", "nulls": 0, "min": None, "max": None} for _ in header]
+
+        for fields in reader:
+            if not fields:
+                # blank line, pandas skips them too
+                continue
+            rows += 1
+            if len(fields) != len(header):
+                malformed += 1
+                continue
+
+            for col, value in zip(columns, fields):
+                if value in NA_VALUES:
+                    col["nulls"] += 1
+                    continue
+                if col["type"] == "str":
+                    continue
+                kind = value_type(value)
+                if TYPE_ORDER[kind] > TYPE_ORDER[col["type"]]:
+                    col["type"] = kind
+                if kind != "str":
+                    number = float(value)
+                    col["min"] = number if col["min"] is None else min(col["min"], number)
+                    col["max"] = number if col["max"] is None else max(col["max"], number)
+
+    for col in columns:
+        if col["type"] in ("str", "empty"):
+            col["min"] = col["max"] = None
+            col["dtype"] = None
+        elif col["type"] == "int" and col["nulls"] == 0:
+            col["dtype"] = "int64"
+        else:
+            col["dtype"] = "float64"
+
+    st = os.stat(csv_path)
+    return {
+        "size": st.st_size,
+        "mtime_ns": st.st_mtime_ns,
+        "sha256": h.hexdigest(),
+        "rows": rows,
+        "malformed_rows": malformed,
+        "columns": dict(zip(header, columns)),
+    }
+
+
+# Writes the profiles to a temporary file first so it is never half written.
+# sources has the files of every source, profiles the profile of every file.
+def save_profile(sources: dict, profiles: dict):
+    os.makedirs(os.path.dirname(PROFILE_PATH), exist_ok=True)
+    tmp_path = PROFILE_PATH + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"sources": sources, "files": profiles}, f, indent=2)
+    os.replace(tmp_path, PROFILE_PATH)
+
+
+# Files of every source, sorted (an empty list if nothing matches)
+def discover_sources() -> dict:
+    sources = {}
+    for name, source in SOURCES.items():
+        files = set()
+        for pattern in source["patterns"]:
+            files.update(glob.glob(os.path.join(RAW_DIR, pattern), recursive=True))
+        sources[name] = sorted(files)
+    return sources
+
+
+# Staging file of a raw file: same path under STAGING_DIR with .arrow
+def staging_path_for(path: str) -> str:
+    rel = os.path.relpath(path, RAW_DIR)
+    return os.path.join(STAGING_DIR, os.path.splitext(rel)[0] + ".arrow")
+
+
+# Parse a raw CSV once with the dtypes of its profile and write it as an
+# Arrow IPC file. Returns the staging path, or None if it could not be written
+# (then transform.py reads the CSV).
+def stage_file(path: str, profile: dict):
+    if feather is None:
+        return None
+    staging_path = staging_path_for(path)
+    tmp_path = staging_path + ".tmp"
+    try:
+        hints = {col: info["dtype"] for col, info in profile["columns"].items() if info["dtype"]}
+        df = pd.read_csv(path, dtype=hints)
+        os.makedirs(os.path.dirname(staging_path), exist_ok=True)
+        feather.write_feather(df, tmp_path, compression="uncompressed")
+        os.replace(tmp_path, staging_path)
+    except (OSError, ValueError, TypeError) as e:
+        logging.warning(f"Could not stage {path}, transform will read the CSV: {e}")
+        return None
+    logging.info(f"Staged {path} -> {staging_path}")
+    return staging_path
+
+
+# Delete staging files of raw files that are not there anymore
+def clean_staging(keep: set):
+    for root, _, files in os.walk(STAGING_DIR):
+        for file in files:
+            path = os.path.join(root, file)
+            if path not in keep:
+                os.remove(path)
+
+
+# Worker processes do not write logs, their messages go back to the main
+# process with the result (see check_file)
+def init_worker():
+    root = logging.getLogger()
+    root.handlers = []
+    root.setLevel(logging.INFO)
+
+
+# Validate one file and, if it is valid, profile it. In a worker process
+# (capture=True) the log messages are collected and returned to be logged by
+# the main process in order.
+def check_file(path: str, required_cols: list[str], capture: bool = True) -> dict:
+    root = logging.getLogger()
+    buffer = logging.handlers.BufferingHandler(capacity=1000)
+    if capture:
+        root.addHandler(buffer)
+    result = {"path": path, "ok": False, "profile": None}
+    try:
+        # 1) Exists and is not empty, 2) Columns check
+        if file_exists_and_not_empty(path) and (not required_cols or validate_columns(path, required_cols)):
+            # 3) Profile
+            try:
+                result["profile"] = profile_csv(path)
+                result["ok"] = True
+            except (OSError, UnicodeDecodeError, csv.Error) as e:
+                logging.error(f"Could not profile {path}: {e}")
+            # 4) Staging copy
+            if result["ok"]:
+                result["profile"]["staging"] = stage_file(path, result["profile"])
+    finally:
+        root.removeHandler(buffer)
+    result["messages"] = [(record.levelno, record.getMessage()) for record in buffer.buffer]
+    return result
+
+
+# Validate and profile every file of every source on a pool of worker
+# processes and write PROFILE_PATH if all of them are valid
+def validate_all_files(workers: int = MAX_WORKERS) -> bool:
     ok = True
+    sources = discover_sources()
+    tasks = []
+    for name, files in sources.items():
+        if not files:
+            logging.error(f"No files for source {name}: {SOURCES[name]['patterns']} in {RAW_DIR}")
+            ok = False
+        tasks += [(path, SOURCES[name]["required_columns"]) for path in files]
 
-    for filename in REQUIRED_FILES:
-        path = os.path.join(RAW_DIR, filename)
+    workers = max(1, min(workers, len(tasks)))
+    if workers == 1:
+        results = [check_file(path, cols, capture=False) for path, cols in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as pool:
+            results = list(pool.map(check_file, *zip(*tasks)))
 
-        # 1) Exists and is not empty
-        if not file_exists_and_not_empty(path):
+    profiles = {}
+    for result in results:
+        for level, message in result["messages"]:
+            logging.log(level, message)
+        if not result["ok"]:
             ok = False
             continue
 
-        # 2) Columns check
-        required_cols = REQUIRED_COLUMNS.get(filename, [])
-        if required_cols:
-            if not validate_columns(path, required_cols):
-                ok = False
+        profile = result["profile"]
+        key = os.path.relpath(result["path"], RAW_DIR)
+        profiles[key] = profile
+        logging.info(f"Profiled {key}: {profile['rows']} rows, "
+                     f"{profile['malformed_rows']} malformed, {len(profile['columns'])} columns")
+        if profile["malformed_rows"]:
+            logging.warning(f"{key} has {profile['malformed_rows']} rows with a wrong number of fields")
 
+    if ok:
+        clean_staging({p["staging"] for p in profiles.values() if p["staging"]})
+        save_profile(sources, profiles)
+        logging.info(f"Profile saved: {PROFILE_PATH} ({len(profiles)} files)")
     return ok
 
 
+# The whole step as a function, so run_pipeline.py can call it in the same process.
+# Raises ValueError if any raw file is not valid.
+def run():
+    logging.info("Starting ingestion validation (local raw data mode)...")
+    if not validate_all_files():
+        raise ValueError("Raw data validation failed, see the errors logged above")
+
+
 def main():
     ensure_folders()
     setup_logging()
 
-    logging.info("Starting ingestion validation (local raw data mode)...")
-    ok = validate_all_files()
-
-    if ok:
-        logging.info("Ingestion validation finished successfully")
-        print("SUCCESS: Raw datasets are ready.")
-    else:
+    try:
+        run()
+    except ValueError:
         logging.error("Ingestion validation finished with errors")
         print("ERROR: Check logs/ingest.log for details.")
         raise SystemExit(1)
 
+    logging.info("Ingestion validation finished successfully")
+    print("SUCCESS: Raw datasets are ready.")
+
 
 if __name__ == "__main__":
     main()
@@ -1,7 +1,18 @@
 import os
+import sys
+import json
+import hashlib
 import logging
+import numpy as np
 import pandas as pd
 
+# pyarrow is optional: with it the raw data is read from the Arrow staging files
+# written by ingest.py and the outputs are also staged for load_dw.py
+try:
+    import pyarrow.feather as feather
+except ImportError:
+    feather = None
+
 RAW_DIR = os.path.join("data", "raw")
 PROCESSED_DIR = os.path.join("data", "processed")
 LOG_DIR = "logs"
@@ -13,6 +24,41 @@ SURVEY_PATH = os.path.join(RAW_DIR, "mxmh_survey_results.csv")
 OUT_MUSIC_BY_GENRE = os.path.join(PROCESSED_DIR, "music_features_by_genre.csv")
 OUT_MENTAL_BY_GENRE = os.path.join(PROCESSED_DIR, "mental_health_by_genre.csv")
 
+# Data quality: values that broke each cleaning rule, by rule and column
+OUT_MUSIC_VIOLATIONS = os.path.join(PROCESSED_DIR, "music_rule_violations.csv")
+OUT_SURVEY_VIOLATIONS = os.path.join(PROCESSED_DIR, "survey_rule_violations.csv")
+
+# Arrow IPC copies of the outputs, read memory-mapped by load_dw.py.
+# The CSVs above are still written for Looker Studio.
+STAGING_DIR = os.path.join("data", "staging", "processed")
+STAGED_MUSIC_BY_GENRE = os.path.join(STAGING_DIR, "music_features_by_genre.arrow")
+STAGED_MENTAL_BY_GENRE = os.path.join(STAGING_DIR, "mental_health_by_genre.arrow")
+
+# Genre spellings that mean the same genre (lowercase label -> genre name).
+# New aliases are added there, not in the code.
+GENRE_MAPPING_PATH = os.path.join("config", "genre_mapping.json")
+
+# Cleaning rules of every source ("music", "survey"). A rule checks one or more
+# columns and the values that break it become NaN:
+#   {"type": "range", "columns": [...], "min": 0, "max": 10}   (min or max can be left out)
+#   {"type": "category", "columns": [...], "allowed": ["Yes", "No"]}
+#   {"type": "regex", "columns": [...], "pattern": "..."}       (whole value must match)
+RULES_PATH = os.path.join("config", "cleaning_rules.json")
+RULE_TYPES = ["range", "category", "regex"]
+
+# Incremental survey mode (--incremental): the survey only grows, so the per-genre
+# partials of the rows already processed are kept here with the newest Timestamp
+# (high-water mark), and each run only cleans the rows after it
+SURVEY_STATE_PATH = os.path.join(PROCESSED_DIR, "survey_state.json")
+TIMESTAMP_FORMAT = "%m/%d/%Y %H:%M:%S"
+
+# Mental health indicators averaged by genre
+MENTAL_COLUMNS = ["Age", "Hours per day", "Anxiety", "Depression", "Insomnia", "OCD"]
+
+# Written by ingest.py, with the files of every raw source and the dtype of
+# every numeric column of those files
+PROFILE_PATH = os.path.join("data", "raw_profile.json")
+
 
 # If folders do not exist, create them
 def ensure_dirs():
@@ -41,40 +87,128 @@ def setup_logging():
 
 #1)Cleaning/Normalization
 
-def normalize_genre(s: pd.Series) -> pd.Series:
-    x = s.astype(str).str.strip().str.lower()
-
-    mapping = {
-        "hip hop": "hip-hop",
-        "hiphop": "hip-hop",
-        "hip-hop": "hip-hop",
-        "r&b": "rnb",
-        "rnb": "rnb",
-        "electronic": "edm",
-        "edm": "edm",
-    }
-    return x.replace(mapping)
-
-def clean_numeric_ranges(df: pd.DataFrame, rules: dict) -> pd.DataFrame:
-    #Apply basic numeric range cleaning.
-    #Values outside the allowed range are set to NaN.
-    
-    for col, (min_v, max_v) in rules.items():
-        if col in df.columns:
-            before_na = df[col].isna().sum()
-
-            # Out-of-range values become NaN
-            df.loc[(df[col] < min_v) | (df[col] > max_v), col] = pd.NA
-
-            after_na = df[col].isna().sum()
-            logging.info(
-                f"Range check {col}: allowed [{min_v},{max_v}] | NaNs {before_na} -> {after_na}"
-            )
+# Genre aliases from GENRE_MAPPING_PATH (no aliases if the file is missing)
+def load_genre_mapping() -> dict:
+    if not os.path.exists(GENRE_MAPPING_PATH):
+        logging.warning(f"Missing {GENRE_MAPPING_PATH}, genres are only stripped and lowercased")
+        return {}
+    with open(GENRE_MAPPING_PATH, "r", encoding="utf-8") as f:
+        mapping = json.load(f)
+    return {k.strip().lower(): v for k, v in mapping.items()}
+
+
+# Normalize genre names as a categorical column. strip/lower and the aliases are
+# applied only to the distinct labels (a few dozen), not to every row, and the
+# rows keep an integer code into the sorted genre names.
+def normalize_genre(s: pd.Series, mapping: dict = None) -> pd.Series:
+    codes, labels = pd.factorize(s)
+    names = pd.Index(labels.astype(str)).str.strip().str.lower()
+
+    if mapping is None:
+        mapping = load_genre_mapping()
+    names = names.map(lambda name: mapping.get(name, name))
+
+    genres = pd.Index(sorted(set(names)))
+    # code of every distinct label in genres, -1 stays -1 (missing label)
+    label_to_genre = genres.get_indexer(names)
+    genre_codes = np.where(codes >= 0, label_to_genre[codes], -1)
+    return pd.Series(pd.Categorical.from_codes(genre_codes, categories=genres), index=s.index, name=s.name)
+
+# Cleaning rules of every source from RULES_PATH (no rules if the file is missing)
+def load_rules() -> dict:
+    if not os.path.exists(RULES_PATH):
+        logging.warning(f"Missing {RULES_PATH}, no cleaning rules are applied")
+        return {}
+    with open(RULES_PATH, "r", encoding="utf-8") as f:
+        rules = json.load(f)
+    for source, source_rules in rules.items():
+        for rule in source_rules:
+            if rule.get("type") not in RULE_TYPES:
+                raise ValueError(f"{RULES_PATH}: unknown rule type in {source}: {rule}")
+    return rules
+
+
+# Short text of what a rule allows, for the violations table
+def rule_condition(rule: dict) -> str:
+    if rule["type"] == "range":
+        return f"[{rule.get('min', '-inf')}, {rule.get('max', 'inf')}]"
+    if rule["type"] == "category":
+        return "in " + "|".join(str(v) for v in rule["allowed"])
+    return f"matches {rule['pattern']}"
+
+
+# Apply the cleaning rules: values that break a rule become NaN (missing values
+# are not checked). Every check (rule, column) gives one column of a boolean
+# mask: all the range checks are one comparison of the numeric block against
+# the min/max vectors, categories and patterns are one isin/fullmatch each.
+# Range columns that are not numeric yet are converted first, values that are
+# not numbers count as range violations.
+# The counts per check come from the same mask and are added to violations,
+# {(type, column, condition): [rows, violations]}, so they can be summed
+# over chunks.
+def apply_rules(df: pd.DataFrame, rules: list, violations: dict = None) -> pd.DataFrame:
+    checks = [(rule, col) for rule in rules for col in rule["columns"] if col in df.columns]
+    if not checks:
+        return df
+
+    mask = np.zeros((len(df), len(checks)), dtype=bool)
+    ranges = [i for i, (rule, _) in enumerate(checks) if rule["type"] == "range"]
+    if ranges:
+        range_cols = [checks[i][1] for i in ranges]
+        not_number = {}
+        for col in dict.fromkeys(range_cols):
+            if not pd.api.types.is_numeric_dtype(df[col]):
+                numeric = pd.to_numeric(df[col], errors="coerce")
+                not_number[col] = (df[col].notna() & numeric.isna()).to_numpy()
+                df[col] = numeric
+        values = df[range_cols].to_numpy(dtype="float64")
+        low = np.array([checks[i][0].get("min", -np.inf) for i in ranges], dtype="float64")
+        high = np.array([checks[i][0].get("max", np.inf) for i in ranges], dtype="float64")
+        mask[:, ranges] = (values < low) | (values > high)
+        for i, col in zip(ranges, range_cols):
+            if col in not_number:
+                mask[:, i] |= not_number[col]
+
+    for i, (rule, col) in enumerate(checks):
+        if rule["type"] == "category":
+            mask[:, i] = (df[col].notna() & ~df[col].isin(rule["allowed"])).to_numpy()
+        elif rule["type"] == "regex":
+            matches = df[col].astype(str).str.fullmatch(rule["pattern"])
+            mask[:, i] = (df[col].notna() & ~matches).to_numpy()
+
+    counts = mask.sum(axis=0)
+    for (rule, col), n in zip(checks, counts):
+        key = (rule["type"], col, rule_condition(rule))
+        entry = violations.setdefault(key, [0, 0]) if violations is not None else [0, 0]
+        entry[0] += len(df)
+        entry[1] += int(n)
+
+    # one NaN assignment per column that has violations (of any of its rules)
+    columns = [col for _, col in checks]
+    for col in dict.fromkeys(columns):
+        bad = mask[:, [i for i, c in enumerate(columns) if c == col]].any(axis=1)
+        if bad.any():
+            df[col] = df[col].mask(bad)
+
+    logging.info(f"Cleaning rules: {len(checks)} checks, {int(counts.sum())} values set to NaN")
     return df
 
 
+# Write the violations of one source: one row per rule and column
+def write_violations(violations: dict, path: str):
+    table = pd.DataFrame(
+        [(rule_type, col, condition, rows, n) for (rule_type, col, condition), (rows, n) in violations.items()],
+        columns=["rule", "column", "condition", "rows_checked", "violations"],
+    )
+    table.to_csv(path, index=False)
+    for row in table[table["violations"] > 0].itertuples():
+        logging.info(f"Rule {row.rule} {row.column} {row.condition}: {row.violations} violations")
+    logging.info(f"Saved: {path}")
+
+
 #Data cleaning for music dataset
-def clean_music(music_df: pd.DataFrame) -> pd.DataFrame:
+def clean_music(music_df: pd.DataFrame, mapping: dict = None, rules: list = None,
+                violations: dict = None) -> pd.DataFrame:
     #Check that the required column (label) exists         the column that says the genre is called label
     required = ["label"]
     for col in required:
@@ -85,7 +219,7 @@ def clean_music(music_df: pd.DataFrame) -> pd.DataFrame:
     music_df = music_df.dropna(subset=["label"]).copy()
 
     # Normalize genre name  
-    music_df["genre"] = normalize_genre(music_df["label"])
+    music_df["genre"] = normalize_genre(music_df["label"], mapping)
 
     # only numeric features 
     numeric_cols = music_df.select_dtypes(include="number").columns.tolist()
@@ -96,6 +230,11 @@ def clean_music(music_df: pd.DataFrame) -> pd.DataFrame:
             # attempt numeric conversion silently
             music_df[c] = pd.to_numeric(music_df[c], errors="coerce")
 
+    # Values that break the cleaning rules become NaN
+    if rules is None:
+        rules = load_rules().get("music", [])
+    music_df = apply_rules(music_df, rules, violations)
+
     numeric_cols = music_df.select_dtypes(include="number").columns.tolist()
 
     # Final table: genre and numeric features
@@ -107,7 +246,8 @@ def clean_music(music_df: pd.DataFrame) -> pd.DataFrame:
 
 
 #Data cleaning for mental health survey dataset
-def clean_survey(survey_df: pd.DataFrame) -> pd.DataFrame:
+def clean_survey(survey_df: pd.DataFrame, mapping: dict = None, rules: list = None,
+                 violations: dict = None) -> pd.DataFrame:
     #Check that the required column (fav genre) exists
     required = ["Fav genre"]
     for col in required:
@@ -118,24 +258,18 @@ def clean_survey(survey_df: pd.DataFrame) -> pd.DataFrame:
     survey_df = survey_df.dropna(subset=["Fav genre"]).copy()
 
     # Normalize genre name
-    survey_df["genre"] = normalize_genre(survey_df["Fav genre"])
+    survey_df["genre"] = normalize_genre(survey_df["Fav genre"], mapping)
 
     # Convert relevant mental health columns to numeric if they exist
     mh_cols = ["Anxiety", "Depression", "Insomnia", "OCD", "Hours per day", "Age"]
     for c in mh_cols:
-        if c in survey_df.columns:
+        if c in survey_df.columns and not pd.api.types.is_numeric_dtype(survey_df[c]):
             survey_df[c] = pd.to_numeric(survey_df[c], errors="coerce")
 
-    # Clean numeric ranges for mental health indicators
-    range_rules = {
-        "Age": (0, 120),
-        "Hours per day": (0, 24),
-        "Anxiety": (0, 10),
-        "Depression": (0, 10),
-        "Insomnia": (0, 10),
-        "OCD": (0, 10),
-    }
-    survey_df = clean_numeric_ranges(survey_df, range_rules)
+    # Ranges of the mental health indicators and the other cleaning rules
+    if rules is None:
+        rules = load_rules().get("survey", [])
+    survey_df = apply_rules(survey_df, rules, violations)
 
     logging.info(f"Survey cleaned: {survey_df.shape[0]} rows, {survey_df.shape[1]} cols")
     return survey_df
@@ -145,7 +279,7 @@ def clean_survey(survey_df: pd.DataFrame) -> pd.DataFrame:
 
 def group_music_by_genre(music_df: pd.DataFrame) -> pd.DataFrame:
     #group numeric music features by genre (mean)
-    grouped = music_df.groupby("genre", as_index=False).mean(numeric_only=True)
+    grouped = music_df.groupby("genre", as_index=False, observed=True).mean(numeric_only=True)
     grouped = grouped.sort_values("genre").reset_index(drop=True)
     logging.info(f"Music aggregated by genre: {grouped.shape[0]} genres")
     return grouped
@@ -156,49 +290,447 @@ def group_mental_by_genre(survey_df: pd.DataFrame) -> pd.DataFrame:
     cols = ["genre"]
 
     # Choose only numeric columns, the ones that are relevant
-    candidates = ["Age", "Hours per day", "Anxiety", "Depression", "Insomnia", "OCD"]
-    cols += [c for c in candidates if c in survey_df.columns]
+    cols += [c for c in MENTAL_COLUMNS if c in survey_df.columns]
 
     tmp = survey_df[cols].copy()
-    grouped = tmp.groupby("genre", as_index=False).mean(numeric_only=True)
+    grouped = tmp.groupby("genre", as_index=False, observed=True).mean(numeric_only=True)
     grouped = grouped.sort_values("genre").reset_index(drop=True)
     logging.info(f"Mental health aggregated by genre: {grouped.shape[0]} genres")
     return grouped
 
 
+#3)Chunked mode: partial aggregates by genre
+
+# Running per-genre aggregates of the chunks read so far: for every genre (row)
+# and column, the number of non-NaN values, their sum and sum of squares (for a
+# std later). Memory depends on the number of genres and columns, not on the
+# number of rows.
+#
+# The sum is a Kahan sum with its compensation, the same algorithm pandas uses
+# in groupby().mean(), and the values of each genre are added in file order,
+# so the means are bit for bit the ones of the whole DataFrame whatever the
+# chunk size. Adding chunk sums instead would differ in the last digit.
+def new_partials() -> dict:
+    empty = np.zeros((0, 0))
+    return {"genres": [], "columns": [], "count": empty.copy(), "sum": empty.copy(),
+            "compensation": empty.copy(), "sum_sq": empty.copy()}
+
+
+# Make room for genres or columns seen for the first time (zeros)
+def grow_partials(partials: dict, genres, columns):
+    new_genres = [g for g in dict.fromkeys(genres) if g not in partials["genres"]]
+    new_columns = [c for c in columns if c not in partials["columns"]]
+    if not new_genres and not new_columns:
+        return
+    partials["genres"] += new_genres
+    partials["columns"] += new_columns
+    for key in ["count", "sum", "compensation", "sum_sq"]:
+        partials[key] = np.pad(partials[key], ((0, len(new_genres)), (0, len(new_columns))))
+
+
+# Add the rows of one cleaned chunk (genre column + numeric columns)
+def add_chunk(partials: dict, chunk: pd.DataFrame) -> dict:
+    genre = chunk["genre"].astype("category")
+    columns = [c for c in chunk.columns if c != "genre"]
+    grow_partials(partials, genre.cat.categories, columns)
+
+    # row of every genre of the chunk in the partials, rows without genre are skipped
+    genre_pos = pd.Index(partials["genres"]).get_indexer(genre.cat.categories)
+    codes = genre.cat.codes.to_numpy()
+    keep = codes >= 0
+    groups = genre_pos[codes[keep]]
+    # columns in the order of the partials, NaN for the ones the chunk does not have
+    values = chunk.reindex(columns=partials["columns"]).to_numpy(dtype="float64")[keep]
+
+    # Kahan updates have to follow the row order inside a genre. Rows are sorted
+    # by genre and then by their position inside the genre, so step k (one slice)
+    # updates the k-th row of every genre at the same time.
+    order = np.argsort(groups, kind="stable")
+    rank = np.arange(len(groups)) - np.searchsorted(groups[order], groups[order])
+    by_rank = np.argsort(rank, kind="stable")
+    order = order[by_rank]
+    groups, values = groups[order], values[order]
+    bounds = np.flatnonzero(np.diff(rank[by_rank])) + 1
+    starts = np.concatenate([[0], bounds]) if len(groups) else []
+    ends = np.concatenate([bounds, [len(groups)]]) if len(groups) else []
+
+    count, total = partials["count"], partials["sum"]
+    compensation, sum_sq = partials["compensation"], partials["sum_sq"]
+    for start, end in zip(starts, ends):
+        g = groups[start:end]
+        v = values[start:end]
+        ok = ~np.isnan(v)
+        s, c = total[g], compensation[g]
+        y = v - c
+        t = s + y
+        new_c = t - s - y
+        # +/- inf values: keep the infinite sum instead of NaN (as pandas)
+        new_c[np.isnan(new_c)] = 0
+        total[g] = np.where(ok, t, s)
+        compensation[g] = np.where(ok, new_c, c)
+        count[g] += ok
+        sum_sq[g] += np.where(ok, v * v, 0.0)
+    return partials
+
+
+# Means by genre from the partials, like group_music_by_genre/group_mental_by_genre
+def partials_to_means(partials: dict) -> pd.DataFrame:
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = np.where(partials["count"] > 0, partials["sum"] / partials["count"], np.nan)
+    grouped = pd.DataFrame(means, columns=partials["columns"])
+    genres = sorted(partials["genres"])
+    grouped.insert(0, "genre", pd.Categorical(partials["genres"], categories=genres))
+    return grouped.sort_values("genre").reset_index(drop=True)
+
+
+# Profile of the raw files written by ingest.py (empty if there is none)
+def load_profile() -> dict:
+    if not os.path.exists(PROFILE_PATH):
+        return {}
+    try:
+        with open(PROFILE_PATH, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        logging.warning(f"Could not read {PROFILE_PATH}: {e}")
+        return {}
+
+
+# Profile of a raw file, only if the file did not change after it was
+# profiled (same size and modification time)
+def profile_entry(path: str, profile: dict):
+    entry = profile.get("files", {}).get(os.path.relpath(path, RAW_DIR))
+    st = os.stat(path)
+    if not entry or entry["size"] != st.st_size or entry["mtime_ns"] != st.st_mtime_ns:
+        return None
+    return entry
+
+
+# Open an Arrow IPC file memory-mapped. With one pandas block per column
+# (split_blocks) numeric columns without missing values are read-only views of
+# the mapped pages instead of copies; text columns and columns with nulls are
+# still converted. self_destruct frees each Arrow column once it is converted.
+# clean_music/clean_survey copy the rows they keep, so the views only save the
+# copy made while reading.
+def read_staged(path: str) -> pd.DataFrame:
+    return feather.read_table(path, memory_map=True).to_pandas(split_blocks=True, self_destruct=True)
+
+
+# Write a table as an Arrow IPC file (uncompressed, so it can be memory-mapped)
+def write_staged(df: pd.DataFrame, path: str):
+    if feather is None:
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    feather.write_feather(df, tmp_path, compression="uncompressed")
+    os.replace(tmp_path, path)
+    logging.info(f"Staged: {path}")
+
+
+# Numeric dtypes of the columns of a raw file from its profile. The profile
+# skips malformed rows (wrong number of fields) when it infers the types, so a
+# shifted row can hold text in a "float" column: no hints for those files.
+def dtype_hints(entry: dict) -> dict:
+    if entry.get("malformed_rows"):
+        return {}
+    return {col: info["dtype"] for col, info in entry.get("columns", {}).items() if info["dtype"]}
+
+
+# Read one raw file. If ingest.py staged it as Arrow the staging file is used,
+# if not the CSV is parsed with the numeric dtypes from the ingest profile,
+# so pandas does not have to guess them; text columns as before.
+def read_raw(path: str, profile: dict = None) -> pd.DataFrame:
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"Missing file: {path}")
+
+    entry = profile_entry(path, load_profile() if profile is None else profile) or {}
+    staging_path = entry.get("staging")
+    if feather is not None and staging_path and os.path.exists(staging_path):
+        return read_staged(staging_path)
+
+    hints = dtype_hints(entry)
+    if hints:
+        try:
+            return pd.read_csv(path, dtype=hints)
+        except (ValueError, TypeError) as e:
+            logging.warning(f"dtypes from {PROFILE_PATH} do not fit {path} ({e}), reading without them")
+    return pd.read_csv(path)
+
+
+# Read one raw file in chunks of chunksize rows, from the Arrow staging file
+# (record batches of the memory-mapped file) or the CSV, like read_raw
+def read_raw_chunks(path: str, chunksize: int, profile: dict = None):
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"Missing file: {path}")
+
+    entry = profile_entry(path, load_profile() if profile is None else profile) or {}
+    staging_path = entry.get("staging")
+    if feather is not None and staging_path and os.path.exists(staging_path):
+        table = feather.read_table(staging_path, memory_map=True)
+        for batch in table.to_batches(max_chunksize=chunksize):
+            yield batch.to_pandas(split_blocks=True)
+        return
+
+    # Like read_raw: with the dtypes of the profile, and if they do not fit a
+    # chunk the rest of the file is read without them (pandas guesses the
+    # dtypes chunk by chunk). The rows already given are skipped, they are the
+    # same rows whatever the dtypes.
+    hints = dtype_hints(entry)
+    done = 0
+    if hints:
+        try:
+            for chunk in pd.read_csv(path, dtype=hints, chunksize=chunksize):
+                yield chunk
+                done += len(chunk)
+            return
+        except (ValueError, TypeError) as e:
+            logging.warning(f"dtypes from {PROFILE_PATH} do not fit {path} ({e}), "
+                            f"reading from row {done} without them")
+    for chunk in pd.read_csv(path, chunksize=chunksize):
+        if done >= len(chunk):
+            done -= len(chunk)
+            continue
+        yield chunk.iloc[done:]
+        done = 0
+
+
+# Chunks of all the files of a raw source, one file after the other (see read_source)
+def read_source_chunks(name: str, default_path: str, chunksize: int):
+    profile = load_profile()
+    files = profile.get("sources", {}).get(name) or [default_path]
+    for path in files:
+        yield from read_raw_chunks(path, chunksize, profile)
+
+
+# Clean every chunk of a raw source and add it to the partials, so only one
+# chunk is in memory at a time
+def aggregate_chunks(name: str, default_path: str, chunksize: int, reduce_chunk) -> pd.DataFrame:
+    partials = new_partials()
+    rows = 0
+    for chunk in read_source_chunks(name, default_path, chunksize):
+        add_chunk(partials, reduce_chunk(chunk))
+        rows += len(chunk)
+    logging.info(f"Aggregated {name} in chunks of {chunksize} rows: {rows} rows, "
+                 f"{len(partials['genres'])} genres")
+    return partials_to_means(partials)
+
+
+# Partials as JSON lists (floats are written with repr, so they are read back exactly)
+def partials_to_json(partials: dict) -> dict:
+    return {key: value.tolist() if isinstance(value, np.ndarray) else value for key, value in partials.items()}
+
+
+def partials_from_json(data: dict) -> dict:
+    shape = (len(data["genres"]), len(data["columns"]))
+    return {key: np.array(value, dtype="float64").reshape(shape) if key not in ["genres", "columns"] else value
+            for key, value in data.items()}
+
+
+# Hash of the cleaning rules and genre aliases the state was built with: if they
+# change, the rows already processed would be cleaned differently
+def survey_settings_hash(rules: list, mapping: dict) -> str:
+    text = json.dumps({"rules": rules, "mapping": mapping}, sort_keys=True)
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+# State of the incremental survey mode, None if there is none or it was built
+# with other settings
+def load_survey_state(settings: str):
+    if not os.path.exists(SURVEY_STATE_PATH):
+        return None
+    try:
+        with open(SURVEY_STATE_PATH, "r", encoding="utf-8") as f:
+            state = json.load(f)
+    except (OSError, ValueError) as e:
+        logging.warning(f"Could not read {SURVEY_STATE_PATH}: {e}")
+        return None
+    if state.get("settings") != settings:
+        logging.info("Cleaning rules or genre aliases changed, rebuilding the survey state")
+        return None
+    state["partials"] = partials_from_json(state["partials"])
+    state["violations"] = {tuple(key): [rows, n] for *key, rows, n in state["violations"]}
+    return state
+
+
+def save_survey_state(state: dict):
+    os.makedirs(os.path.dirname(SURVEY_STATE_PATH), exist_ok=True)
+    data = {**state, "partials": partials_to_json(state["partials"]),
+            "violations": [[*key, rows, n] for key, (rows, n) in state["violations"].items()]}
+    tmp_path = SURVEY_STATE_PATH + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, SURVEY_STATE_PATH)
+
+
+# Incremental survey aggregation. A row is new if its Timestamp is after the
+# high-water mark, or equal to it and not one of the rows with that Timestamp
+# already counted. Only the new rows are cleaned and added to the saved
+# partials (the Kahan sums continue where they stopped, so the means are the
+# same as a full rebuild). The survey file is still read, but cleaning and
+# grouping depend on the new rows only.
+#
+# Every other row must have been counted before: if not (rows removed, rows
+# without Timestamp, late rows before the mark) the state is built again from
+# all the rows. Values corrected in old rows are not detected, that is what
+# full_rebuild is for.
+def aggregate_survey_incremental(rules: list, mapping: dict, chunksize: int = None,
+                                 full_rebuild: bool = False) -> tuple[pd.DataFrame, dict]:
+    settings = survey_settings_hash(rules, mapping)
+    state = None if full_rebuild else load_survey_state(settings)
+    if state is None:
+        state = {"settings": settings, "high_water_mark": None, "rows_at_mark": 0, "rows": 0,
+                 "partials": new_partials(), "violations": {}}
+    mark = pd.Timestamp(state["high_water_mark"]) if state["high_water_mark"] else None
+
+    if chunksize:
+        chunks = read_source_chunks("survey", SURVEY_PATH, chunksize)
+    else:
+        chunks = [read_source("survey", SURVEY_PATH)]
+
+    old_rows, new_rows, seen_at_mark = 0, 0, 0
+    newest, rows_at_newest = None, 0
+    for chunk in chunks:
+        if "Timestamp" not in chunk.columns:
+            raise ValueError("Incremental survey mode needs the Timestamp column")
+        ts = pd.to_datetime(chunk["Timestamp"], format=TIMESTAMP_FORMAT, errors="coerce")
+
+        if mark is None:
+            new = np.ones(len(chunk), dtype=bool)
+        else:
+            at_mark = (ts == mark).to_numpy()
+            rank = seen_at_mark + np.cumsum(at_mark)
+            new = (ts > mark).to_numpy() | (at_mark & (rank > state["rows_at_mark"]))
+            seen_at_mark += int(at_mark.sum())
+        old_rows += int((~new).sum())
+        new_rows += int(new.sum())
+
+        # newest Timestamp of all the rows and how many rows have it (next mark)
+        chunk_max = ts.max()
+        if pd.notna(chunk_max):
+            if newest is None or chunk_max > newest:
+                newest, rows_at_newest = chunk_max, int((ts == chunk_max).sum())
+            elif chunk_max == newest:
+                rows_at_newest += int((ts == chunk_max).sum())
+
+        if new.any():
+            cleaned = clean_survey(chunk[new], mapping, rules, state["violations"])
+            add_chunk(state["partials"], cleaned[["genre"] + [c for c in MENTAL_COLUMNS if c in cleaned.columns]])
+
+    if old_rows != state["rows"]:
+        logging.warning(f"Survey rows before {mark} changed ({state['rows']} -> {old_rows}), full rebuild")
+        return aggregate_survey_incremental(rules, mapping, chunksize, full_rebuild=True)
+
+    state["rows"] += new_rows
+    state["high_water_mark"] = newest.isoformat() if newest is not None else None
+    state["rows_at_mark"] = rows_at_newest
+    save_survey_state(state)
+    logging.info(f"Incremental survey: {new_rows} new rows, {state['rows']} in total, "
+                 f"high-water mark {state['high_water_mark']}")
+    return partials_to_means(state["partials"]), state["violations"]
+
+
+# Read all the files of a raw source as one DataFrame. The files are the ones
+# ingest.py validated (one CSV or many partitions); without a profile only
+# default_path is read.
+def read_source(name: str, default_path: str) -> pd.DataFrame:
+    profile = load_profile()
+    files = profile.get("sources", {}).get(name) or [default_path]
+    frames = [read_raw(path, profile) for path in files]
+    if len(frames) == 1:
+        return frames[0]
+    logging.info(f"Read {len(frames)} partitions of {name}")
+    return pd.concat(frames, ignore_index=True)
+
+
+# Music branch: raw features -> clean -> mean by genre. It does not depend on
+# the survey branch, so run_pipeline.py can run both at the same time.
+# The raw CSV is read only if music_raw is not given. With save=False the
+# processed CSV and the rule violations are not written. With chunksize the raw files are read and
+# aggregated chunksize rows at a time (same result, bounded memory).
+def run_music(music_raw: pd.DataFrame = None, save: bool = True, chunksize: int = None) -> pd.DataFrame:
+    rules = load_rules().get("music", [])
+    violations = {}
+    if music_raw is None and chunksize:
+        mapping = load_genre_mapping()
+        music_by_genre = aggregate_chunks("music", MUSIC_PATH, chunksize,
+                                          lambda chunk: clean_music(chunk, mapping, rules, violations))
+    else:
+        if music_raw is None:
+            music_raw = read_source("music", MUSIC_PATH)
+            logging.info(f"Loaded music raw: {music_raw.shape}")
+        music_by_genre = group_music_by_genre(clean_music(music_raw, rules=rules, violations=violations))
+
+    if save:
+        os.makedirs(PROCESSED_DIR, exist_ok=True)
+        music_by_genre.to_csv(OUT_MUSIC_BY_GENRE, index=False)
+        logging.info(f"Saved: {OUT_MUSIC_BY_GENRE}")
+        write_staged(music_by_genre, STAGED_MUSIC_BY_GENRE)
+        write_violations(violations, OUT_MUSIC_VIOLATIONS)
+    return music_by_genre
+
+
+# Survey branch: raw survey -> clean -> mean by genre (same as run_music).
+# With incremental only the responses after the last run are cleaned (see
+# aggregate_survey_incremental), full_rebuild processes all of them again.
+def run_survey(survey_raw: pd.DataFrame = None, save: bool = True, chunksize: int = None,
+               incremental: bool = False, full_rebuild: bool = False) -> pd.DataFrame:
+    rules = load_rules().get("survey", [])
+    violations = {}
+    if survey_raw is None and (incremental or full_rebuild):
+        mental_by_genre, violations = aggregate_survey_incremental(rules, load_genre_mapping(), chunksize,
+                                                                   full_rebuild)
+    elif survey_raw is None and chunksize:
+        mapping = load_genre_mapping()
+
+        def reduce_chunk(chunk):
+            chunk = clean_survey(chunk, mapping, rules, violations)
+            return chunk[["genre"] + [c for c in MENTAL_COLUMNS if c in chunk.columns]]
+
+        mental_by_genre = aggregate_chunks("survey", SURVEY_PATH, chunksize, reduce_chunk)
+    else:
+        if survey_raw is None:
+            survey_raw = read_source("survey", SURVEY_PATH)
+            logging.info(f"Loaded survey raw: {survey_raw.shape}")
+        mental_by_genre = group_mental_by_genre(clean_survey(survey_raw, rules=rules, violations=violations))
+
+    if save:
+        os.makedirs(PROCESSED_DIR, exist_ok=True)
+        mental_by_genre.to_csv(OUT_MENTAL_BY_GENRE, index=False)
+        logging.info(f"Saved: {OUT_MENTAL_BY_GENRE}")
+        write_staged(mental_by_genre, STAGED_MENTAL_BY_GENRE)
+        write_violations(violations, OUT_SURVEY_VIOLATIONS)
+    return mental_by_genre
+
+
+# The whole step as a function, so run_pipeline.py can call it in the same process
+# and pass the DataFrames to the next step in memory: both branches, one after
+# the other. The raw CSVs are read only if the raw DataFrames are not given.
+def run(music_raw: pd.DataFrame = None, survey_raw: pd.DataFrame = None,
+        save: bool = True, chunksize: int = None, incremental: bool = False,
+        full_rebuild: bool = False) -> tuple[pd.DataFrame, pd.DataFrame]:
+    return (run_music(music_raw, save, chunksize),
+            run_survey(survey_raw, save, chunksize, incremental, full_rebuild))
+
+
 def main():
     ensure_dirs()
     setup_logging()
 
     logging.info("Starting transform step (clean + aggregate)...")
 
-    if not os.path.exists(MUSIC_PATH):
-        logging.error(f"Missing file: {MUSIC_PATH}")
+    # --chunksize N: read and aggregate the raw files N rows at a time
+    chunksize = None
+    if "--chunksize" in sys.argv:
+        chunksize = int(sys.argv[sys.argv.index("--chunksize") + 1])
+
+    # --incremental: only clean the survey responses after the last run,
+    # --full-rebuild: process all of them again (after corrections)
+    try:
+        run(chunksize=chunksize, incremental="--incremental" in sys.argv,
+            full_rebuild="--full-rebuild" in sys.argv)
+    except FileNotFoundError as e:
+        logging.error(str(e))
         raise SystemExit(1)
 
-    if not os.path.exists(SURVEY_PATH):
-        logging.error(f"Missing file: {SURVEY_PATH}")
-        raise SystemExit(1)
-
-    # 1) Load
-    music_raw = pd.read_csv(MUSIC_PATH)
-    survey_raw = pd.read_csv(SURVEY_PATH)
-    logging.info(f"Loaded music raw: {music_raw.shape}, survey raw: {survey_raw.shape}")
-
-    # 2) Clean
-    music_clean = clean_music(music_raw)
-    survey_clean = clean_survey(survey_raw)
-
-    # 3) Group by genre
-    music_by_genre = group_music_by_genre(music_clean)
-    mental_by_genre = group_mental_by_genre(survey_clean)
-
-    # 4) Save processed outputs
-    music_by_genre.to_csv(OUT_MUSIC_BY_GENRE, index=False)
-    mental_by_genre.to_csv(OUT_MENTAL_BY_GENRE, index=False)
-
-    logging.info(f"Saved: {OUT_MUSIC_BY_GENRE}")
-    logging.info(f"Saved: {OUT_MENTAL_BY_GENRE}")
     logging.info("Transform step finished successfully")
 
     print("SUCCESS: processed tables created in data/processed/")
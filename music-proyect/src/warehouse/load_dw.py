@@ -1,8 +1,16 @@
 import os
 import logging
 import sqlite3
+import numpy as np
 import pandas as pd
 
+# pyarrow is optional: with it the processed tables are read memory-mapped from
+# the Arrow staging files written by transform.py instead of the CSVs
+try:
+    import pyarrow.feather as feather
+except ImportError:
+    feather = None
+
 PROCESSED_DIR = os.path.join("data", "processed")
 WAREHOUSE_DIR = os.path.join("data", "warehouse")
 LOG_DIR = "logs"
@@ -11,7 +19,13 @@ LOG_FILE = os.path.join(LOG_DIR, "warehouse.log")
 MUSIC_BY_GENRE_PATH = os.path.join(PROCESSED_DIR, "music_features_by_genre.csv")
 MENTAL_BY_GENRE_PATH = os.path.join(PROCESSED_DIR, "mental_health_by_genre.csv")
 
+STAGING_DIR = os.path.join("data", "staging", "processed")
+STAGED_MUSIC_BY_GENRE = os.path.join(STAGING_DIR, "music_features_by_genre.arrow")
+STAGED_MENTAL_BY_GENRE = os.path.join(STAGING_DIR, "mental_health_by_genre.arrow")
+
 DB_PATH = os.path.join(WAREHOUSE_DIR, "music_dw.sqlite")
+# Seconds a connection waits for another one holding the write lock on DB_PATH
+DB_TIMEOUT_SECONDS = 60
 
 # If folders do not exist, create them
 def ensure_dirs():
@@ -39,7 +53,7 @@ def setup_logging():
 
 # Connect to SQLite database (creates file if it doesn't exist)
 def connect_db(db_path: str) -> sqlite3.Connection:
-    conn = sqlite3.connect(db_path)
+    conn = sqlite3.connect(db_path, timeout=DB_TIMEOUT_SECONDS)
     #enforce foreign keys 
     conn.execute("PRAGMA foreign_keys = ON;")
     return conn
@@ -107,23 +121,33 @@ def clear_facts(conn: sqlite3.Connection):
     logging.info("Cleared fact tables (fact_music_features, fact_mental_health)")
 
 
+# Fact rows (genre_id, name, value) of a by-genre table. genre is categorical
+# (see normalize_genre in transform.py): the dim_genre id is looked up once per
+# category and the rows get it through their category code, so there is no
+# per-row dict lookup. Rows of genres not in dim_genre are skipped and NaN
+# values are kept as None for SQLite.
+def fact_rows(df: pd.DataFrame, genre_id_map: dict) -> list:
+    genre = df["genre"].astype("category")
+    category_ids = pd.Series(genre_id_map, dtype="float64").reindex(genre.cat.categories).to_numpy()
+    codes = genre.cat.codes.to_numpy()
+    genre_ids = np.where(codes >= 0, category_ids[codes], np.nan)
+
+    known = ~np.isnan(genre_ids)
+    value_cols = [c for c in df.columns if c != "genre"]
+    values = df[value_cols].to_numpy(dtype="float64")[known]
+
+    # one row per genre and column, all the columns of a genre together
+    long = pd.DataFrame({
+        "genre_id": np.repeat(genre_ids[known].astype("int64"), len(value_cols)),
+        "name": np.tile(value_cols, len(values)),
+        "value": values.ravel(),
+    })
+    long["value"] = long["value"].astype(object).where(long["value"].notna(), None)
+    return list(long.itertuples(index=False, name=None))
+
+
 def load_music_facts(conn: sqlite3.Connection, music_df: pd.DataFrame, genre_id_map: dict):
-    rows_to_insert = []
-    feature_cols = [c for c in music_df.columns if c != "genre"]
-
-    for _, row in music_df.iterrows():
-        #Transform genre to genre_id
-        genre = row["genre"]
-        genre_id = genre_id_map.get(genre)
-        if genre_id is None:
-            continue
-
-        for c in feature_cols:
-            val = row[c]
-            # Keep NaN as None for SQLite
-            if pd.isna(val):
-                val = None
-            rows_to_insert.append((genre_id, c, val))
+    rows_to_insert = fact_rows(music_df, genre_id_map)
 
     cur = conn.cursor()
     cur.executemany(
@@ -135,20 +159,7 @@ def load_music_facts(conn: sqlite3.Connection, music_df: pd.DataFrame, genre_id_
 
 #the same that load_music_facts but for mental health indicators
 def load_mental_facts(conn: sqlite3.Connection, mental_df: pd.DataFrame, genre_id_map: dict):
-    rows_to_insert = []
-    metric_cols = [c for c in mental_df.columns if c != "genre"]
-
-    for _, row in mental_df.iterrows():
-        genre = row["genre"]
-        genre_id = genre_id_map.get(genre)
-        if genre_id is None:
-            continue
-
-        for c in metric_cols:
-            val = row[c]
-            if pd.isna(val):
-                val = None
-            rows_to_insert.append((genre_id, c, val))
+    rows_to_insert = fact_rows(mental_df, genre_id_map)
 
     cur = conn.cursor()
     cur.executemany(
@@ -159,63 +170,101 @@ def load_mental_facts(conn: sqlite3.Connection, mental_df: pd.DataFrame, genre_i
     logging.info(f"Loaded mental health facts: {len(rows_to_insert)} rows")
 
 
-def main():
-    ensure_dirs()
-    setup_logging()
+# Read one processed table: the Arrow staging file (memory-mapped) if it is
+# there and not older than the CSV, if not the CSV
+def read_table(csv_path: str, staged_path: str) -> pd.DataFrame:
+    if (feather is not None and os.path.exists(staged_path)
+            and os.path.getmtime(staged_path) >= os.path.getmtime(csv_path)):
+        # numeric columns without nulls stay views of the mapped file (see read_staged in transform.py)
+        return feather.read_table(staged_path, memory_map=True).to_pandas(split_blocks=True, self_destruct=True)
+    return pd.read_csv(csv_path)
+
 
-    # 1) Check inputs exist
+# Read the processed tables written by transform.py
+def read_processed() -> tuple[pd.DataFrame, pd.DataFrame]:
     if not os.path.exists(MUSIC_BY_GENRE_PATH):
-        logging.error(f"Missing processed file: {MUSIC_BY_GENRE_PATH}")
-        raise SystemExit(1)
+        raise FileNotFoundError(f"Missing processed file: {MUSIC_BY_GENRE_PATH}")
 
     if not os.path.exists(MENTAL_BY_GENRE_PATH):
-        logging.error(f"Missing processed file: {MENTAL_BY_GENRE_PATH}")
-        raise SystemExit(1)
+        raise FileNotFoundError(f"Missing processed file: {MENTAL_BY_GENRE_PATH}")
 
-    logging.info("Starting warehouse load (SQLite)...")
+    return (read_table(MUSIC_BY_GENRE_PATH, STAGED_MUSIC_BY_GENRE),
+            read_table(MENTAL_BY_GENRE_PATH, STAGED_MENTAL_BY_GENRE))
 
-    # 2) Read processed CSVs
-    music_df = pd.read_csv(MUSIC_BY_GENRE_PATH)
-    mental_df = pd.read_csv(MENTAL_BY_GENRE_PATH)
 
-    # Basic validation: must have genre column
-    if "genre" not in music_df.columns:
-        logging.error("music_features_by_genre.csv missing 'genre' column")
-        raise SystemExit(1)
-    if "genre" not in mental_df.columns:
-        logging.error("mental_health_by_genre.csv missing 'genre' column")
-        raise SystemExit(1)
+# Check that a processed table has the genre column
+def check_genre_column(df: pd.DataFrame, name: str):
+    if "genre" not in df.columns:
+        raise ValueError(f"{name} missing 'genre' column")
+
 
+# Create the schema, insert the genres of both tables in dim_genre and empty the
+# fact tables. Returns the genre -> genre_id mapping for the fact loads.
+def build_dim(music_df: pd.DataFrame, mental_df: pd.DataFrame) -> dict:
+    check_genre_column(music_df, "music_features_by_genre.csv")
+    check_genre_column(mental_df, "mental_health_by_genre.csv")
     logging.info(f"Loaded processed tables: music={music_df.shape}, mental={mental_df.shape}")
 
-    # 3) Connect DW
+    os.makedirs(WAREHOUSE_DIR, exist_ok=True)
     conn = connect_db(DB_PATH)
-
     try:
-        # 4) Create schema
+        # Create schema
         create_schema(conn)
 
-        # 5) Insert genres (union from both tables)
+        # Insert genres (union from both tables)
         all_genres = sorted(set(music_df["genre"].dropna().astype(str)) | set(mental_df["genre"].dropna().astype(str)))
         upsert_genres(conn, all_genres)
 
-        # 6) Get mapping genre -> id
+        # Get mapping genre -> id
         genre_id_map = get_genre_id_map(conn)
         logging.info(f"dim_genre size: {len(genre_id_map)}")
 
-        # 7) Clear facts and load fresh (so reruns don't duplicate)
+        # Clear facts and load fresh (so reruns don't duplicate)
         clear_facts(conn)
+    finally:
+        conn.close()
+    return genre_id_map
 
-        # 8) Load facts
-        load_music_facts(conn, music_df, genre_id_map)
-        load_mental_facts(conn, mental_df, genre_id_map)
-
-        logging.info(f"Warehouse load finished successfully, DB at: {DB_PATH}")
-        print("SUCCESS: Data Warehouse created/updated:", DB_PATH)
 
+# Load one fact table (load_music_facts or load_mental_facts) with its own
+# connection. SQLite allows one writer at a time, so the fact loads must run
+# one after the other (run_pipeline.py chains them)
+def load_facts(load_func, df: pd.DataFrame, genre_id_map: dict):
+    conn = connect_db(DB_PATH)
+    try:
+        load_func(conn, df, genre_id_map)
     finally:
         conn.close()
 
 
+# The whole step as a function, so run_pipeline.py can call it in the same process
+# with the DataFrames returned by transform.run(). If they are not given the
+# processed CSVs are read.
+def run(music_df: pd.DataFrame = None, mental_df: pd.DataFrame = None):
+    logging.info("Starting warehouse load (SQLite)...")
+
+    if music_df is None or mental_df is None:
+        music_df, mental_df = read_processed()
+
+    genre_id_map = build_dim(music_df, mental_df)
+    load_facts(load_music_facts, music_df, genre_id_map)
+    load_facts(load_mental_facts, mental_df, genre_id_map)
+
+    logging.info(f"Warehouse load finished successfully, DB at: {DB_PATH}")
+
+
+def main():
+    ensure_dirs()
+    setup_logging()
+
+    try:
+        run()
+    except (FileNotFoundError, ValueError) as e:
+        logging.error(str(e))
+        raise SystemExit(1)
+
+    print("SUCCESS: Data Warehouse created/updated:", DB_PATH)
+
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()